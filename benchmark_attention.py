@@ -0,0 +1,104 @@
+import time
+from argparse import ArgumentParser, Namespace
+
+import torch
+import torch.nn.functional as F
+
+from model import Model
+from util import pad_mask
+from constants import *
+
+
+def broadcast_attend(model, hidden, embed_query, attention_mask):
+    """
+    the original topic/rhyme attention, which materializes batch x seq x N x 300 tensors. kept here as the reference.
+    """
+    attention_tensor = model.attention_linear(hidden).unsqueeze(2) * embed_query.unsqueeze(1) # batch x seq x N x 300
+    attention_weights = F.softmax(attention_tensor.sum(dim=3), dim=1) # batch x seq x N
+    attention_weights = attention_weights * attention_mask.unsqueeze(2)
+    hidden = model.attention_value_linear(hidden)
+    return (hidden.unsqueeze(2) * attention_weights.unsqueeze(3)).sum(dim=1) # batch x seq x N x 300 -> batch x N x 300
+
+
+def make_inputs(batch_size, seq_length, num_words, device):
+    torch.manual_seed(0)
+    model = Model(Namespace(task='topic'), 50257, 100, verbose=False).to(device)
+    model.eval()
+    hidden = torch.randn(batch_size, seq_length, HIDDEN_DIM).to(device)
+    embed_query = torch.randn(batch_size, num_words, HIDDEN_DIM).to(device)
+    lengths = torch.randint(1, seq_length + 1, (batch_size,))
+    lengths[0] = seq_length
+    attention_mask = pad_mask(lengths).permute(1, 0).to(device)
+    return model, hidden, embed_query, attention_mask
+
+
+def cpu_memory(field):
+    """
+    read a memory field (in bytes) from /proc/self/status. linux only.
+    """
+    with open('/proc/self/status', 'r') as rf:
+        for line in rf:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+
+
+def reset_peak_memory(device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        return torch.cuda.memory_allocated()
+    else:
+        with open('/proc/self/clear_refs', 'w') as wf:
+            wf.write('5') # resets the peak rss (VmHWM) to the current rss
+        return cpu_memory('VmRSS')
+
+
+def peak_memory(device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated()
+    else:
+        return cpu_memory('VmHWM')
+
+
+def measure(method, batch_size, seq_length, num_words, repeats, device):
+    """
+    returns (seconds per call, peak extra memory in MB)
+    """
+    model, hidden, embed_query, attention_mask = make_inputs(batch_size, seq_length, num_words, device)
+    attend = model.attend if method == 'matmul' else lambda *a: broadcast_attend(model, *a)
+    with torch.no_grad():
+        base_memory = reset_peak_memory(device)
+        start = time.time()
+        for _ in range(repeats):
+            attend(hidden, embed_query, attention_mask)
+        end_memory = peak_memory(device)
+    return (time.time() - start) / repeats, (end_memory - base_memory) / 2**20
+
+
+def main(args):
+    print('\t'.join(['seq', 'N', 'broadcast_ms', 'matmul_ms', 'broadcast_peak_mb', 'matmul_peak_mb', 'max_abs_diff']))
+    for seq_length in args.seq_lengths:
+        for num_words in args.num_words:
+            model, hidden, embed_query, attention_mask = make_inputs(args.batch_size, seq_length, num_words, args.device)
+            with torch.no_grad():
+                max_diff = (model.attend(hidden, embed_query, attention_mask) - broadcast_attend(model, hidden, embed_query, attention_mask)).abs().max().item()
+            del model, hidden, embed_query, attention_mask
+            broadcast_time, broadcast_memory = measure('broadcast', args.batch_size, seq_length, num_words, args.repeats, args.device)
+            matmul_time, matmul_memory = measure('matmul', args.batch_size, seq_length, num_words, args.repeats, args.device)
+            print('\t'.join([str(seq_length), str(num_words), '{:.2f}'.format(broadcast_time * 1000), '{:.2f}'.format(matmul_time * 1000), 
+                             '{:.1f}'.format(broadcast_memory), '{:.1f}'.format(matmul_memory), '{:.2e}'.format(max_diff)]))
+
+
+if __name__=='__main__':
+    parser = ArgumentParser()
+
+    parser.add_argument('--batch_size', type=int, default=200, help='number of candidates scored at once, i.e. precondition_topk')
+    parser.add_argument('--seq_lengths', type=int, nargs='+', default=[10, 20, 40, 80])
+    parser.add_argument('--num_words', type=int, nargs='+', default=[1, 10, 30], help='sizes of the future word bag N')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--device', type=str, default='cpu', choices=['cpu', 'cuda'])
+
+    args = parser.parse_args()
+
+    main(args)
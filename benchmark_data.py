@@ -0,0 +1,63 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from data import Dataset
+from constants import *
+
+
+def decode_word_boundary(tokenizer, sentence, pos):
+    """
+    the original newline example search, which decodes two prefixes per token. kept here as the reference.
+    """
+    while pos < len(sentence):
+        if len(tokenizer.decode(sentence[:pos]).split()) == len(tokenizer.decode(sentence[:pos + 1]).split()):
+            pos += 1
+        else:
+            break
+    return pos
+
+
+def measure(dataset, num_examples, seed):
+    """
+    returns (examples per second, the examples)
+    """
+    split_loader = dataset.loader('train', num_workers=0, indices=list(range(num_examples)), seed=seed).dataset
+    start = time.time()
+    examples = [split_loader[i] for i in range(len(split_loader))]
+    return len(examples) / (time.time() - start), examples
+
+
+def same_examples(examples, other_examples):
+    return all(all(torch.equal(torch.as_tensor(x), torch.as_tensor(y)) for x, y in zip(example, other_example)) 
+               for example, other_example in zip(examples, other_examples))
+
+
+def main(args):
+    dataset = Dataset(args)
+    num_examples = min(args.num_examples, len(dataset.splits['train']))
+    next_word_boundary = dataset.next_word_boundary
+    dataset.next_word_boundary = lambda sentence, word_counts, pos: decode_word_boundary(dataset.tokenizer, sentence, pos)
+    decode_speed, decode_examples = measure(dataset, num_examples, args.seed)
+    dataset.next_word_boundary = next_word_boundary
+    speed, examples = measure(dataset, num_examples, args.seed)
+    print('\t'.join(['examples', 'decode_examples_per_sec', 'examples_per_sec', 'same_examples']))
+    print('\t'.join([str(num_examples), '{:.1f}'.format(decode_speed), '{:.1f}'.format(speed), str(same_examples(decode_examples, examples))]))
+
+
+if __name__=='__main__':
+    parser = ArgumentParser()
+
+    parser.add_argument('--data_dir', type=str, default=None)
+    parser.add_argument('--corpus', type=str, default=None, help='pre-tokenized corpus from corpus.py, used instead of --data_dir')
+    parser.add_argument('--dataset_info', type=str, help='saved dataset info')
+    parser.add_argument('--num_examples', type=int, default=10000, help='newline examples to build with each method')
+    parser.add_argument('--seed', type=int, default=1)
+
+    args = parser.parse_args()
+    args.task = 'newline'
+    args.batch_size = 1
+    args.glove_file, args.rhyme_info, args.debug = None, None, False
+
+    main(args)
@@ -0,0 +1,106 @@
+import time
+import pickle
+from argparse import ArgumentParser
+
+import torch
+from transformers import MarianTokenizer, MarianMTModel, LogitsProcessorList
+
+from model import Model
+from predict_formality import predict_formality, encode_sources
+from fudge import FudgeLogitsProcessor, IncrementalPredictor
+from constants import *
+
+
+def native_search(model, tokenizer, conditioning_model, input_text, args):
+    """
+    huggingface's own beam search (greedy if num_beams is 1), without fudge. the reference for throughput.
+    """
+    with torch.no_grad():
+        encoded_input, attention_mask = encode_sources(tokenizer, input_text, model.config.pad_token_id, args.device)
+        model.generate(encoded_input, attention_mask=attention_mask, num_beams=args.num_beams, max_length=args.length_cutoff, length_penalty=1.0, early_stopping=False)
+
+
+def native_fudge_search(model, tokenizer, conditioning_model, input_text, args):
+    """
+    fudge as a logits processor inside huggingface's generate, which keeps finished sentences in the batch (they only skip the predictor).
+    the reference for what fudge.generate saves by dropping them.
+    """
+    with torch.no_grad():
+        encoded_input, attention_mask = encode_sources(tokenizer, input_text, model.config.pad_token_id, args.device)
+        text_start = torch.ones(len(input_text) * args.num_beams).long().to(args.device)
+        eos_token_id, pad_token_id = model.config.eos_token_id, model.config.pad_token_id
+        conditioning = FudgeLogitsProcessor([(IncrementalPredictor(conditioning_model, text_start), args.condition_lambda)], 
+                                            precondition_topk=args.precondition_topk, 
+                                            exact_topk=2 * args.num_beams if args.num_beams > 1 else 1,
+                                            finished=lambda input_ids: ((input_ids[:, 1:] == eos_token_id) | (input_ids[:, 1:] == pad_token_id)).any(dim=1))
+        model.generate(encoded_input, attention_mask=attention_mask, logits_processor=LogitsProcessorList([conditioning]), num_beams=args.num_beams, 
+                max_length=args.length_cutoff, length_penalty=1.0, early_stopping=False, bad_words_ids=[[pad_token_id]])
+
+
+def fudge_search(condition_lambda):
+    def decode(model, tokenizer, conditioning_model, input_text, args):
+        predict_formality(model, tokenizer, conditioning_model, input_text, None, precondition_topk=args.precondition_topk, length_cutoff=args.length_cutoff,
+                condition_lambda=condition_lambda, device=args.device, num_beams=args.num_beams, length_penalty=1.0, early_stopping=False)
+    return decode
+
+
+def measure(decode, model, tokenizer, conditioning_model, inputs, args):
+    """
+    returns seconds to translate all the inputs, args.batch_size at a time (similar lengths together, as in evaluate_formality)
+    """
+    inputs = sorted(inputs, key=len)
+    if args.device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for i in range(0, len(inputs), args.batch_size):
+        decode(model, tokenizer, conditioning_model, inputs[i:i + args.batch_size], args)
+    if args.device == 'cuda':
+        torch.cuda.synchronize()
+    return time.time() - start
+
+
+def main(args):
+    with open(args.dataset_info, 'rb') as rf:
+        dataset_info = pickle.load(rf)
+    tokenizer = MarianTokenizer.from_pretrained(args.model_string)
+    tokenizer.add_special_tokens({'pad_token': PAD_TOKEN})
+    pad_id = tokenizer.encode(PAD_TOKEN)[0]
+    model = MarianMTModel.from_pretrained(args.model_string, return_dict=True).to(args.device)
+    model.eval()
+    checkpoint = torch.load(args.ckpt, map_location=args.device)
+    conditioning_model = Model(checkpoint['args'], pad_id, len(dataset_info.index2word), verbose=False)
+    conditioning_model.load_state_dict(checkpoint['state_dict'])
+    conditioning_model = conditioning_model.to(args.device)
+    conditioning_model.eval()
+
+    with open(args.in_file, 'r') as rf:
+        inputs = [line.strip() for line in rf][:args.max_sentences]
+    methods = [('native', native_search),
+               ('native_with_fudge_processor', native_fudge_search), # finished sentences stay in the batch
+               ('fudge_lambda0', fudge_search(0.0)), # just the decoding loop, no predictor
+               ('fudge', fudge_search(args.condition_lambda))]
+    measure(methods[0][1], model, tokenizer, conditioning_model, inputs[:args.batch_size], args) # warmup
+    print('\t'.join(['method', 'sec', 'sentences_per_sec', 'slowdown']))
+    native_time = None
+    for name, decode in methods:
+        seconds = measure(decode, model, tokenizer, conditioning_model, inputs, args)
+        native_time = seconds if native_time is None else native_time
+        print('\t'.join([name, '{:.2f}'.format(seconds), '{:.2f}'.format(len(inputs) / seconds), '{:.2f}x'.format(seconds / native_time)]))
+
+
+if __name__=='__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--ckpt', type=str, required=True)
+    parser.add_argument('--dataset_info', type=str, required=True, help='saved dataset info')
+    parser.add_argument('--model_string', type=str, default='Helsinki-NLP/opus-mt-es-en')
+    parser.add_argument('--in_file', type=str, required=True, help='file of source sentences')
+    parser.add_argument('--max_sentences', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_beams', type=int, default=4, help='1 for greedy')
+    parser.add_argument('--precondition_topk', type=int, default=200)
+    parser.add_argument('--condition_lambda', type=float, default=1.0)
+    parser.add_argument('--length_cutoff', type=int, default=512)
+    parser.add_argument('--device', type=str, default='cuda', choices=['cpu', 'cuda'])
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,93 @@
+import time
+import random
+import copy
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from data import Dataset
+from model import Model
+from main import train, validate
+from util import grad_scaler
+from poetry_util import load_phonetics_table
+from constants import *
+
+
+def run(dataset, precision, args):
+    """
+    train a predictor from the same init with the given precision (or load --ckpt), then validate it with that precision.
+    returns (val BCE, seconds spent training, seconds spent validating)
+    """
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    args.precision = precision
+    if args.ckpt:
+        checkpoint = torch.load(args.ckpt, map_location=args.device)
+        model = Model(checkpoint['args'], dataset.gpt_pad_id, len(dataset.index2word), rhyme_group_size=len(dataset.index2rhyme_group) if args.task == 'rhyme' else None)
+        model.load_state_dict(checkpoint['state_dict'])
+    else:
+        model = Model(args, dataset.gpt_pad_id, len(dataset.index2word), rhyme_group_size=len(dataset.index2rhyme_group) if args.task == 'rhyme' else None, glove_embeddings=dataset.glove_embeddings)
+    model = model.to(args.device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    scaler = grad_scaler(args.device, precision)
+    criterion = nn.BCEWithLogitsLoss().to(args.device)
+    start = time.time()
+    data_start_index = 0
+    for epoch in range(args.epochs):
+        data_start_index = train(model, dataset, optimizer, scaler, criterion, epoch, args, data_start_index)
+    train_time = time.time() - start
+    start = time.time()
+    val_bce = validate(model, dataset, criterion, 0, args)
+    return float(val_bce), train_time, time.time() - start
+
+
+def main(args):
+    if args.phonetics_table is not None:
+        load_phonetics_table(args.phonetics_table)
+    dataset = Dataset(args)
+    train_split = copy.copy(dataset.splits['train']) # train shuffles it in place
+    results = []
+    for precision in args.precisions:
+        dataset.splits['train'] = copy.copy(train_split)
+        results.append((precision,) + run(dataset, precision, args))
+    print('\t'.join(['precision', 'val_bce', 'val_bce_diff', 'train_sec', 'val_sec']))
+    for precision, val_bce, train_time, val_time in results:
+        print('\t'.join([precision, '{:.5f}'.format(val_bce), '{:+.5f}'.format(val_bce - results[0][1]), '{:.1f}'.format(train_time), '{:.1f}'.format(val_time)]))
+
+
+if __name__=='__main__':
+    parser = ArgumentParser()
+
+    # DATA
+    parser.add_argument('--task', type=str, required=True, choices=['iambic', 'rhyme', 'newline', 'topic', 'formality'])
+    parser.add_argument('--data_dir', type=str, default=None)
+    parser.add_argument('--corpus', type=str, default=None, help='pre-tokenized corpus from corpus.py, used instead of --data_dir')
+    parser.add_argument('--glove_file', type=str, help='glove embedding init, for topic task')
+    parser.add_argument('--glove_cache', type=str, default=None)
+    parser.add_argument('--dataset_info', type=str, help='saved dataset info')
+    parser.add_argument('--rhyme_info', type=str, help='saved dataset rhyme info, for a ckpt with task==rhyme')
+    parser.add_argument('--phonetics_table', type=str, default=None)
+    parser.add_argument('--ckpt', type=str, default=None, help='start every mode from this ckpt instead of a fresh model')
+
+    # COMPARISON
+    parser.add_argument('--precisions', type=str, nargs='+', default=['fp32', 'bf16', 'fp16'], choices=['fp32', 'bf16', 'fp16'], help='the first is the baseline for val_bce_diff')
+    parser.add_argument('--epochs', type=int, default=1, help='training epochs per mode; 0 to just compare validation of --ckpt')
+    parser.add_argument('--epoch_max_len', type=int, default=1000)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--device', type=str, default='cuda', choices=['cpu', 'cuda'])
+    parser.add_argument('--num_workers', type=int, default=20)
+    parser.add_argument('--length_buckets', action='store_true', default=False)
+    parser.add_argument('--max_tokens', type=int, default=None)
+    parser.add_argument('--debug', action='store_true', default=False)
+    parser.add_argument('--train_print_freq', type=int, default=100)
+
+    args = parser.parse_args()
+    args.world_size, args.rank = 1, 0
+    args.checkpoint_freq = None # train only checkpoints mid-epoch when asked to
+
+    main(args)
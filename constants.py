@@ -13,12 +13,16 @@ VOCAB_SIZE = 50000
 
 FORMALITY_MAX_LEN = 200
 
+CORPUS_CHUNK_SIZE = 1000 # sentences per tokenization job in corpus.py
+BUCKET_BATCHES = 100 # batches' worth of examples sorted by length together when bucketing
+
 GLOVE_PRINT_PROGRESS_FREQ = 1000000
 GLOVE_DIM = 300
 HIDDEN_DIM = 300
 RNN_DIM = 150
 
 MIN_SENTENCE_LENGTH = 3
+MAX_EXAMPLE_DRAWS = 10 # draws from a sentence when building its example, before standing in another sentence
 
 POETRY_LINE_SYLLABLES = 10
 MAX_SYLLABLES_PER_WORD = 10 # no way anything is more
@@ -27,6 +31,11 @@ MAX_COUNT_SYLLABLE_INPUT_LENGTH = 25 # for just a couplet, shouldn't need more
 COUNT_SYLLABLE_DIM = 100
 UNKNOWN_RHYME_GROUP = 'UNKNOWN_RHYME_GROUP'
 PHRASE_ENDS = '.?!'
+TOKEN_STARTS_WORD, TOKEN_IS_WHITESPACE, TOKEN_CONTINUES_WORD = 0, 1, 2 # indices into the per-line syllable counts in predict_poetry
+
+PRUNING_CHUNKS = 8 # when pruning fudge candidates, the predictor first scores this fraction of them, then twice as many each time
+
+PHONETICS_CACHE_SIZE = 200000 # words; bounds the lru caches in poetry_util
 
 POETRY_BANNED_TOKENS = [198, 50256, 628, 220] # newlines and eos and such
 
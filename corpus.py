@@ -0,0 +1,214 @@
+import os
+import pickle
+from collections import defaultdict
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+import numpy as np
+from tqdm import tqdm
+from transformers import AutoTokenizer
+
+from constants import *
+
+CORPUS_SPLITS = ['train', 'val', 'test'] # split codes in a corpus with preassigned splits; -1 means not preassigned
+CORPUS_TOKEN_DTYPE = np.int32
+CORPUS_WORD_COUNT_DTYPE = np.uint16
+
+
+def read_sentences(data_dir):
+    """
+    yield the stripped lines of every file under data_dir, in the order Dataset has always read them.
+    """
+    for root, _, filenames in os.walk(data_dir):
+        for fname in filenames:
+            with open(os.path.join(root, fname), 'r') as rf:
+                for line in rf:
+                    yield line.strip()
+
+
+def read_formality_examples(data_dir):
+    """
+    yield (sentence, label, split) for the GYAFC formal/informal files under data_dir,
+    holding out the first FORMALITY_VAL_SIZE // 2 train lines of each category for val.
+    """
+    for category, label in [('formal', 1), ('informal', 0)]:
+        with open(os.path.join(data_dir, 'train', category), 'r') as rf:
+            for i, line in enumerate(rf):
+                if len(line) > FORMALITY_MAX_LEN:
+                    line = ' '.join(line.strip()[:FORMALITY_MAX_LEN].split()[:-1]) # cutoff words until below max len; chosen so only ~20 examples affected in dataset
+                yield line.strip(), label, 'val' if i < FORMALITY_VAL_SIZE // 2 else 'train'
+    for category, label in [('formal', 1), ('informal', 0)]:
+        with open(os.path.join(data_dir, 'test', category), 'r') as rf:
+            for line in rf:
+                if len(line) > FORMALITY_MAX_LEN:
+                    line = ' '.join(line.strip()[:FORMALITY_MAX_LEN].split()[:-1]) # cutoff words until below max len
+                yield line.strip(), label, 'test'
+
+
+class TokenizedCorpus:
+    """
+    a corpus tokenized once by build_tokenized_corpus, read back through memory maps so examples are zero-copy slices
+    shared by all the loader workers. sentence i has tokens[offsets[i]:offsets[i+1]], and word_counts holds, for each token,
+    how many words the decoded sentence prefix up to and including that token has.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta'), 'rb') as rf:
+            self.meta = pickle.load(rf)
+        self.tokenizer_string = self.meta['tokenizer']
+        self.vocab = self.meta['vocab']
+        self.arrays = None
+
+
+    def __len__(self):
+        return self.meta['num_sentences']
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = None # reopen the maps in each process instead of pickling them
+        return state
+
+
+    def load(self, name, dtype):
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r')
+
+
+    def maps(self):
+        if self.arrays is None:
+            self.arrays = {'tokens': self.load('tokens', CORPUS_TOKEN_DTYPE),
+                           'offsets': self.load('offsets', np.int64),
+                           'word_counts': self.load('word_counts', CORPUS_WORD_COUNT_DTYPE),
+                           'text': self.load('text', np.uint8),
+                           'text_offsets': self.load('text_offsets', np.int64),
+                           'labels': self.load('labels', np.int8),
+                           'splits': self.load('splits', np.int8)}
+        return self.arrays
+
+
+    def tokens(self, i):
+        arrays = self.maps()
+        return arrays['tokens'][arrays['offsets'][i]:arrays['offsets'][i+1]]
+
+
+    def word_counts(self, i):
+        arrays = self.maps()
+        return arrays['word_counts'][arrays['offsets'][i]:arrays['offsets'][i+1]]
+
+
+    def text(self, i):
+        arrays = self.maps()
+        return bytes(arrays['text'][arrays['text_offsets'][i]:arrays['text_offsets'][i+1]]).decode('utf-8')
+
+
+    def label(self, i):
+        return int(self.maps()['labels'][i])
+
+
+    def split_indices(self):
+        """
+        sentence indices of each preassigned split, or None if the splits are left to Dataset.
+        """
+        if not self.meta['preassigned_splits']:
+            return None
+        splits = np.asarray(self.maps()['splits'])
+        return {split: np.nonzero(splits == code)[0] for code, split in enumerate(CORPUS_SPLITS)}
+
+
+tokenizer = None # per tokenization worker
+
+def init_worker(tokenizer_string):
+    global tokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_string)
+    tokenizer.add_special_tokens({'pad_token': PAD_TOKEN})
+
+
+def tokenize_chunk(sentences):
+    """
+    tokenize the sentences exactly as Dataset does, and count the words of every decoded prefix.
+    returns flat tokens, flat word counts, and the number of tokens per sentence.
+    """
+    all_tokens, all_word_counts, lengths = [], [], []
+    for sentence in sentences:
+        tokens = tokenizer.encode(sentence)
+        all_tokens += tokens
+        all_word_counts += [len(tokenizer.decode(tokens[:i+1]).split()) for i in range(len(tokens))]
+        lengths.append(len(tokens))
+    return np.array(all_tokens, dtype=CORPUS_TOKEN_DTYPE), np.array(all_word_counts, dtype=CORPUS_WORD_COUNT_DTYPE), lengths
+
+
+def chunks(iterable, size):
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def build_tokenized_corpus(examples, tokenizer_string, save_path, count_vocab=True, num_workers=20):
+    """
+    tokenize (sentence, label, split) examples once and write them to save_path for TokenizedCorpus, streaming to disk as we go.
+    label is -1 if there is none, and split is None if Dataset should make the splits itself.
+    """
+    os.makedirs(save_path, exist_ok=True)
+    vocab = defaultdict(lambda: 0)
+    files = {name: open(os.path.join(save_path, name), 'wb') for name in ['tokens', 'offsets', 'word_counts', 'text', 'text_offsets', 'labels', 'splits']}
+    num_sentences, num_tokens, preassigned_splits = 0, 0, False
+    files['offsets'].write(np.zeros(1, dtype=np.int64).tobytes())
+    files['text_offsets'].write(np.zeros(1, dtype=np.int64).tobytes())
+
+    def sentence_chunks():
+        # the per-sentence metadata is written here as the pool consumes chunks, so the raw text is only read once
+        nonlocal preassigned_splits
+        num_bytes = 0
+        for chunk in chunks(examples, CORPUS_CHUNK_SIZE):
+            encoded = [sentence.encode('utf-8') for sentence, _, _ in chunk]
+            files['text'].write(b''.join(encoded))
+            files['text_offsets'].write((num_bytes + np.cumsum([len(e) for e in encoded])).astype(np.int64).tobytes())
+            num_bytes += sum(len(e) for e in encoded)
+            files['labels'].write(np.array([label for _, label, _ in chunk], dtype=np.int8).tobytes())
+            files['splits'].write(np.array([-1 if split is None else CORPUS_SPLITS.index(split) for _, _, split in chunk], dtype=np.int8).tobytes())
+            preassigned_splits = preassigned_splits or any(split is not None for _, _, split in chunk)
+            if count_vocab:
+                for sentence, _, _ in chunk:
+                    for word in sentence.split(' '):
+                        vocab[word] += 1
+            yield [sentence for sentence, _, _ in chunk]
+
+    with Pool(num_workers, initializer=init_worker, initargs=(tokenizer_string,)) as pool:
+        for tokens, word_counts, lengths in tqdm(pool.imap(tokenize_chunk, sentence_chunks())):
+            files['tokens'].write(tokens.tobytes())
+            files['word_counts'].write(word_counts.tobytes())
+            files['offsets'].write((num_tokens + np.cumsum(lengths)).astype(np.int64).tobytes())
+            num_sentences += len(lengths)
+            num_tokens += len(tokens)
+    for f in files.values():
+        f.close()
+
+    meta = {'tokenizer': tokenizer_string,
+            'vocab': dict(vocab),
+            'num_sentences': num_sentences,
+            'num_tokens': num_tokens,
+            'preassigned_splits': preassigned_splits}
+    with open(os.path.join(save_path, 'meta'), 'wb') as wf:
+        pickle.dump(meta, wf)
+    return meta
+
+
+if __name__=='__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--task', type=str, required=True, choices=['iambic', 'rhyme', 'newline', 'topic', 'formality'])
+    parser.add_argument('--data_dir', type=str, required=True)
+    parser.add_argument('--save_path', type=str, required=True, help='directory to write the tokenized corpus to; pass it to main.py as --corpus')
+    parser.add_argument('--num_workers', type=int, default=20, help='num processes for tokenizing')
+    args = parser.parse_args()
+
+    if args.task == 'formality':
+        meta = build_tokenized_corpus(read_formality_examples(args.data_dir), FORMALITY_MODEL_STRING, args.save_path, count_vocab=False, num_workers=args.num_workers)
+    else:
+        meta = build_tokenized_corpus(((sentence, -1, None) for sentence in read_sentences(args.data_dir)), TOPIC_MODEL_STRING, args.save_path, num_workers=args.num_workers)
+    print('sentences', meta['num_sentences'])
+    print('tokens', meta['num_tokens'])
@@ -2,6 +2,7 @@ import random
 import math
 import os
 import pickle
+import hashlib
 from collections import defaultdict, namedtuple
 import string
 
@@ -13,7 +14,8 @@ from tqdm import tqdm
 import torch
 
 from util import suppress_stdout
-from poetry_util import is_iambic, count_syllables, get_rhymes, get_rhyme_group
+from corpus import TokenizedCorpus, read_sentences, read_formality_examples
+from poetry_util import is_iambic, count_syllables, word_rhyme_tail
 from constants import *
 
 DatasetInfo = namedtuple('DatasetInfo', 
@@ -21,54 +23,69 @@ DatasetInfo = namedtuple('DatasetInfo',
 RhymeInfo = namedtuple('RhymeInfo', 
                 ['word2rhyme_group', 'rhyme_group_counts', 'rhyme_groups', 'index2rhyme_group', 'rhyme_group2index', 'total_rhyme_groups'])
 
+Batch = namedtuple('Batch', 
+                ['inputs', 'lengths', 'future_words', 'log_probs', 'labels', 'classification_labels', 'syllables_to_go', 'future_word_num_syllables', 'rhyme_group_index'])
+
 def collate(batch):
-    pad_id = batch[0][4]
-    inputs = [b[0] for b in batch]
+    """
+    pad and stack examples into a Batch, which still unpacks like the old 9-tuple. 
+    inputs and per-token classification labels are scattered into preallocated padded buffers in one go.
+    """
     lengths = torch.LongTensor([b[1] for b in batch])
     max_length = lengths.max()
-    for i in range(len(inputs)):
-        if len(inputs[i]) < max_length:
-            inputs[i] = torch.cat([inputs[i], torch.zeros(max_length - len(inputs[i])).long()], dim=0) # actually 0 is fine as pad since it's masked out
-    inputs = torch.stack(inputs, dim=0)
+    length_mask = torch.arange(max_length).unsqueeze(0) < lengths.unsqueeze(1) # batch x seq
+    inputs = torch.zeros(len(batch), max_length, dtype=torch.long) # actually 0 is fine as pad since it's masked out
+    inputs.masked_scatter_(length_mask, torch.cat([torch.as_tensor(b[0], dtype=torch.long) for b in batch]))
     future_words = torch.LongTensor([b[2] for b in batch]).unsqueeze(0).expand(len(batch), -1).clone() # batch x N=batch
-    labels = torch.zeros_like(future_words).long()
-    labels = labels.scatter(1, torch.arange(len(batch)).unsqueeze(1), torch.ones(len(batch)).long().unsqueeze(1)).clone()
+    labels = torch.eye(len(batch), dtype=torch.long) # each example's own future word is the positive one
+    labels[torch.BoolTensor([b[9] for b in batch])] = -1 # copies padding out a val/test batch are still negatives for the rest, but don't count themselves
     log_probs = torch.Tensor([b[3] for b in batch])
     classification_labels = [b[5] for b in batch] # batch
     if type(classification_labels[0]) == list:
         for i in range(len(classification_labels)):
             assert len(classification_labels[i]) == lengths[i]
-            if len(classification_labels[i]) < max_length:
-                classification_labels[i] = torch.cat([torch.LongTensor(classification_labels[i]), -1 + torch.zeros(max_length - len(classification_labels[i])).long()], dim=0)
-            else:
-                classification_labels[i] = torch.LongTensor(classification_labels[i])
-        classification_labels = torch.stack(classification_labels, dim=0) # batch x seq
+        flat_labels = torch.LongTensor([label for labels_i in classification_labels for label in labels_i])
+        classification_labels = torch.full((len(batch), max_length), -1, dtype=torch.long).masked_scatter_(length_mask, flat_labels) # batch x seq
     else:
         assert type(classification_labels[0]) == int
         classification_labels = torch.LongTensor(classification_labels) # they're just int labels
     syllables_to_go = torch.LongTensor([b[6] for b in batch])
     future_word_num_syllables = torch.LongTensor([b[7] for b in batch])
     rhyme_group_index = torch.LongTensor([b[8] for b in batch])
-    return (inputs, lengths, future_words, log_probs, labels, classification_labels, syllables_to_go, future_word_num_syllables, rhyme_group_index)
+    return Batch(inputs=inputs, 
+                 lengths=lengths, 
+                 future_words=future_words, 
+                 log_probs=log_probs, 
+                 labels=labels, 
+                 classification_labels=classification_labels, 
+                 syllables_to_go=syllables_to_go, 
+                 future_word_num_syllables=future_word_num_syllables, 
+                 rhyme_group_index=rhyme_group_index)
 
 
 def load_rhyme_info(index2word, vocab):
-    word2rhyme_group = defaultdict(lambda: UNKNOWN_RHYME_GROUP)
+    """
+    group the vocab into rhyme groups in one pass. the group of a word is its rhyme tail (see poetry_util.word_rhyme_tail), 
+    a short phone string like 'EY1' that words share exactly when they perfectly rhyme, so we never list out the rhymes themselves.
+    """
+    word2rhyme_group = {}
     rhyme_group_counts = defaultdict(lambda: 0)
-    rhyme_groups = set()
+    canonical_rhyme_groups = {} # share one string object per group, so the pickled rhyme info stores each group once
     for word in index2word:
-        try:
-            rhyme_group = get_rhyme_group(word)
-            word2rhyme_group[word] = rhyme_group
-            rhyme_group_counts[rhyme_group] += (vocab[word] if word in vocab else 1) # for rare words not in vocab, just use 1
-            rhyme_groups.add(rhyme_group)
-        except:
-            rhyme_group_counts[UNKNOWN_RHYME_GROUP] += (vocab[word] if word in vocab else 1)
+        count = vocab[word] if word in vocab else 1 # for rare words not in vocab, just use 1
+        rhyme_group = word_rhyme_tail(word)
+        if rhyme_group is None:
+            rhyme_group_counts[UNKNOWN_RHYME_GROUP] += count
+            continue
+        rhyme_group = canonical_rhyme_groups.setdefault(rhyme_group, rhyme_group)
+        word2rhyme_group[word] = rhyme_group
+        rhyme_group_counts[rhyme_group] += count
+    rhyme_groups = set(canonical_rhyme_groups.keys())
     index2rhyme_group = [UNKNOWN_RHYME_GROUP] + sorted(list(rhyme_groups))
     rhyme_group2index = {s: i for i, s in enumerate(index2rhyme_group)}
     total_rhyme_groups = sum(rhyme_group_counts.values())
 
-    return RhymeInfo(word2rhyme_group=dict(word2rhyme_group), 
+    return RhymeInfo(word2rhyme_group=word2rhyme_group, 
                      rhyme_group_counts=dict(rhyme_group_counts), 
                      rhyme_groups=rhyme_groups, 
                      index2rhyme_group=index2rhyme_group, 
@@ -76,6 +93,48 @@ def load_rhyme_info(index2word, vocab):
                      total_rhyme_groups=total_rhyme_groups)
 
 
+def load_glove_embeddings(glove_file, words, cache_dir=None):
+    """
+    glove vectors for whichever of words have one, as (word -> row, float32 matrix of rows x GLOVE_DIM).
+    streams the glove text file and only parses the lines for those words. if cache_dir is given, the result is saved there
+    as a binary matrix plus word index, which later calls with the same words and the same glove file (path, size and modification 
+    time) just memory-map.
+    """
+    words = set(words)
+    if cache_dir is not None:
+        glove_stat = os.stat(glove_file)
+        key = '\n'.join([os.path.abspath(glove_file), str(glove_stat.st_size), str(glove_stat.st_mtime_ns), str(GLOVE_DIM)] + sorted(words))
+        key_hash = hashlib.md5(key.encode('utf-8')).hexdigest()
+        index_file, vectors_file = os.path.join(cache_dir, 'glove_words_' + key_hash), os.path.join(cache_dir, 'glove_vectors_' + key_hash)
+        if os.path.exists(index_file) and os.path.exists(vectors_file):
+            print('loading cached glove embeddings')
+            with open(index_file, 'rb') as rf:
+                word2row = pickle.load(rf)
+            if len(word2row) == 0: # can't memory-map an empty file
+                return word2row, np.zeros((0, GLOVE_DIM), dtype=np.float32)
+            return word2row, np.memmap(vectors_file, dtype=np.float32, mode='r').reshape(-1, GLOVE_DIM)
+    vectors = {}
+    with open(glove_file, 'r') as rf:
+        for i, line in enumerate(rf):
+            if i % GLOVE_PRINT_PROGRESS_FREQ == 0:
+                print(i)
+            word = line.split(maxsplit=1)[0] if len(line.strip()) > 0 else None
+            if word not in words:
+                continue
+            line = line.strip().split()
+            if len(line) != GLOVE_DIM + 1:
+                continue # skip multi-word embeddings which are rare anyway
+            vectors[word] = np.array([float(x) for x in line[1:]], dtype=np.float32)
+    word2row = {word: i for i, word in enumerate(vectors.keys())}
+    vectors = np.stack(list(vectors.values()), axis=0) if len(vectors) > 0 else np.zeros((0, GLOVE_DIM), dtype=np.float32)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        vectors.tofile(vectors_file)
+        with open(index_file, 'wb') as wf:
+            pickle.dump(word2row, wf)
+    return word2row, vectors
+
+
 class Dataset:
     def __init__(self, args):
         print('loading data')
@@ -91,45 +150,39 @@ class Dataset:
         self.tokenizer = AutoTokenizer.from_pretrained(FORMALITY_MODEL_STRING if self.formality else TOPIC_MODEL_STRING)
         self.tokenizer.add_special_tokens({'pad_token': PAD_TOKEN})
         self.gpt_pad_id = self.tokenizer.encode(PAD_TOKEN)[0] # actually just the vocab size
-        sentences = []
+        self.token_texts = {} # decoded text of each token, filled in as needed
+        self.shuffle_seeds = {'train': None, 'val': None, 'test': None} # seed of the latest shuffle of each split, to redo it when resuming
+        self.unshuffled = {} # each split's order before its first shuffle
+        self.token_lengths = {} # raw sentence -> its length in tokens, filled in as bucketing needs them without a tokenized corpus
+        self.corpus = None
         self.vocab = defaultdict(lambda: 0)
-        if self.formality:
+        if args.corpus is not None:
+            print('loading tokenized corpus')
+            self.corpus = TokenizedCorpus(args.corpus)
+            assert self.corpus.tokenizer_string == (FORMALITY_MODEL_STRING if self.formality else TOPIC_MODEL_STRING)
+            preassigned_splits = self.corpus.split_indices()
+            if self.formality:
+                self.vocab['placeholder'] = 1 # anything so we don't crash
+                self.splits = preassigned_splits
+            else:
+                for word, count in self.corpus.vocab.items():
+                    self.vocab[word] = count
+                sentences = np.arange(len(self.corpus)) # examples are sentence indices into the corpus
+                random.shuffle(sentences) # same permutation as shuffling the raw sentences below
+                self.splits = self.make_splits(sentences, args.debug)
+        elif self.formality:
             self.vocab['placeholder'] = 1 # anything so we don't crash
-            train, val, test = [], [], []
-            for category, label in [('formal', 1), ('informal', 0)]:
-                with open(os.path.join(args.data_dir, 'train', category), 'r') as rf:
-                    for i, line in enumerate(rf):
-                        if len(line) > FORMALITY_MAX_LEN:
-                            line = ' '.join(line.strip()[:FORMALITY_MAX_LEN].split()[:-1]) # cutoff words until below max len; chosen so only ~20 examples affected in dataset
-                        if i < FORMALITY_VAL_SIZE // 2:
-                            val.append((line.strip(), label))
-                        else:
-                            train.append((line.strip(), label))
-                with open(os.path.join(args.data_dir, 'test', category), 'r') as rf:
-                    for line in rf:
-                        if len(line) > FORMALITY_MAX_LEN:
-                            line = ' '.join(line.strip()[:FORMALITY_MAX_LEN].split()[:-1]) # cutoff words until below max len
-                        test.append((line.strip(), label))
-            self.splits = {}
-            self.splits['train'], self.splits['val'], self.splits['test'] = train, val, test
+            self.splits = {'train': [], 'val': [], 'test': []}
+            for line, label, split in read_formality_examples(args.data_dir):
+                self.splits[split].append((line, label))
         else: # topic / poetry
-            for root, _, filenames in os.walk(args.data_dir):
-                for fname in filenames:
-                    with open(os.path.join(root, fname), 'r') as rf:
-                        for line in rf:
-                            sentences.append(line.strip())
-                            for word in line.strip().split(' '):
-                                self.vocab[word] += 1
+            sentences = []
+            for line in read_sentences(args.data_dir):
+                sentences.append(line)
+                for word in line.split(' '):
+                    self.vocab[word] += 1
             random.shuffle(sentences)
-            self.splits = {}
-            if args.debug:
-                self.splits['val'] = sentences
-                self.splits['test'] = sentences
-                self.splits['train'] = sentences
-            else:
-                self.splits['val'] = sentences[:TOPIC_VAL_SIZE]
-                self.splits['test'] = sentences[TOPIC_VAL_SIZE:2*TOPIC_VAL_SIZE]
-                self.splits['train'] = sentences[2*TOPIC_VAL_SIZE:]
+            self.splits = self.make_splits(sentences, args.debug)
 
         if args.dataset_info is not None:
             print('loading dataset info from file')
@@ -146,29 +199,20 @@ class Dataset:
                 print('no glove embeddings given')
                 for word, _ in words_values[VOCAB_SIZE:]: # only use somewhat common tokens
                     del self.vocab[word]
-                glove_embeddings = None
             else:
                 print('loading glove embeddings')
-                glove_embeddings = {}
-                with open(args.glove_file, 'r') as rf:
-                    for i, line in enumerate(rf):
-                        if i % GLOVE_PRINT_PROGRESS_FREQ == 0:
-                            print(i)
-                        line = line.strip().split()
-                        if len(line) != GLOVE_DIM + 1:
-                            continue # skip multi-word embeddings which are rare anyway
-                        glove_embeddings[line[0]] = [float(x) for x in line[1:]]
+                glove_word2row, glove_vectors = load_glove_embeddings(args.glove_file, self.vocab.keys(), cache_dir=args.glove_cache)
                 for word, _ in words_values:
-                    if word not in glove_embeddings:
+                    if word not in glove_word2row:
                         del self.vocab[word]
             self.total_words = sum(self.vocab.values())
             self.index2word = [PAD_TOKEN] + sorted(list(self.vocab.keys()))
             self.word2index = {s: i for i, s in enumerate(self.index2word)}
             self.vocab = dict(self.vocab) # so we can pickle later
-            if glove_embeddings is None:
+            if args.glove_file is None:
                 self.glove_embeddings = None
             else:
-                self.glove_embeddings = torch.stack([torch.zeros(GLOVE_DIM)] + [torch.Tensor(glove_embeddings[word]) for word in self.index2word[1:]], dim=0)
+                self.glove_embeddings = torch.cat([torch.zeros(1, GLOVE_DIM), torch.from_numpy(glove_vectors[[glove_word2row[word] for word in self.index2word[1:]]])], dim=0)
 
             self.dataset_info = DatasetInfo(index2word=self.index2word,
                                             word2index=self.word2index,
@@ -176,6 +220,11 @@ class Dataset:
                                             vocab=self.vocab,
                                             glove_embeddings=self.glove_embeddings)
         
+        if self.corpus is not None: # sentences this short can never give a valid example, so leave them out up front
+            sentence_lengths = np.diff(np.asarray(self.corpus.maps()['offsets']))
+            for split in self.splits:
+                self.splits[split] = self.splits[split][sentence_lengths[self.splits[split]] > MIN_SENTENCE_LENGTH]
+
         if self.rhyme:
             if args.rhyme_info is not None:
                 print('loading rhyme info from file')
@@ -195,221 +244,462 @@ class Dataset:
             print('vocab size', len(self.index2word))
 
 
+    def make_splits(self, sentences, debug):
+        splits = {}
+        if debug:
+            splits['val'] = sentences
+            splits['test'] = sentences
+            splits['train'] = sentences
+        else:
+            splits['val'] = sentences[:TOPIC_VAL_SIZE]
+            splits['test'] = sentences[TOPIC_VAL_SIZE:2*TOPIC_VAL_SIZE]
+            splits['train'] = sentences[2*TOPIC_VAL_SIZE:]
+        return splits
+
+
+    def get_sentence(self, example):
+        """
+        raw text, classification label (-1 if none), tokens, and the per-token prefix word counts (None without a tokenized corpus) of an example.
+        """
+        if self.corpus is not None:
+            return self.corpus.text(example), self.corpus.label(example), torch.from_numpy(self.corpus.tokens(example).astype(np.int64)), self.corpus.word_counts(example)
+        raw_sentence, classification_label = example if self.formality else (example, -1)
+        return raw_sentence, classification_label, self.tokenizer.encode(raw_sentence, return_tensors='pt')[0], None
+
+
+    def num_words_in_prefix(self, sentence, word_counts, length):
+        """
+        number of words in the decoded first length tokens of sentence.
+        """
+        if word_counts is None:
+            return len(self.tokenizer.decode(sentence[:length]).split())
+        return int(word_counts[length-1]) if length > 0 else 0
+
+
+    def token_text(self, token):
+        token = int(token)
+        if token not in self.token_texts:
+            self.token_texts[token] = self.tokenizer.decode([token])
+        return self.token_texts[token]
+
+
+    def prefix_syllables(self, tokens, max_syllables=POETRY_LINE_SYLLABLES):
+        """
+        count_syllables of each decoded prefix tokens[:1], tokens[:2], ..., stopping after the first one over max_syllables.
+        we add one token's text at a time and only recount the word it changes, so this is linear instead of decoding every prefix;
+        if the tokens don't decode the same way one at a time (e.g. a character split across tokens), fall back to decoding every prefix.
+        """
+        counts = []
+        text, last_word, complete_syllables = '', '', 0 # syllables of the words before last_word
+        for token in tokens:
+            piece = self.token_text(token)
+            text += piece
+            words = (last_word + piece).split()
+            if len(piece) > 0 and piece[-1].isspace():
+                complete_syllables += count_syllables(' '.join(words))
+                last_word = ''
+            elif len(words) > 0:
+                complete_syllables += count_syllables(' '.join(words[:-1]))
+                last_word = words[-1]
+            counts.append(complete_syllables + count_syllables(last_word))
+            if counts[-1] > max_syllables:
+                break
+        if text != self.tokenizer.decode(tokens[:len(counts)]):
+            counts = []
+            for i in range(1, len(tokens) + 1):
+                counts.append(count_syllables(self.tokenizer.decode(tokens[:i])))
+                if counts[-1] > max_syllables:
+                    break
+        return counts
+
+
+    def next_word_boundary(self, sentence, word_counts, pos):
+        """
+        the first position p >= pos such that adding token p changes how many words the decoded prefix has, or len(sentence) if there's none.
+        with a tokenized corpus this is a lookup in the per-token word counts. otherwise we add one token's text at a time,
+        falling back to decoding every prefix if the tokens don't decode the same way one at a time.
+        """
+        if word_counts is not None:
+            changes = np.nonzero(word_counts[pos:] != word_counts[pos-1:-1])[0]
+            return pos + int(changes[0]) if len(changes) > 0 else len(sentence)
+        text = self.tokenizer.decode(sentence[:pos])
+        last_word = '' if len(text) == 0 or text[-1].isspace() else text.split()[-1]
+        boundary = pos
+        while boundary < len(sentence):
+            piece = self.token_text(sentence[boundary])
+            text += piece
+            words = (last_word + piece).split()
+            if len(words) != (1 if len(last_word) > 0 else 0):
+                break
+            last_word = '' if len(words) == 0 or (len(piece) > 0 and piece[-1].isspace()) else words[-1]
+            boundary += 1
+        if text == self.tokenizer.decode(sentence[:boundary + 1]):
+            return boundary
+        boundary = pos
+        while boundary < len(sentence) and len(self.tokenizer.decode(sentence[:boundary]).split()) == len(self.tokenizer.decode(sentence[:boundary + 1]).split()):
+            boundary += 1
+        return boundary
+
+
     def shuffle(self, split, seed=None):
+        """
+        put the split in a random order drawn from seed. the order depends only on the seed, not on earlier shuffles, so a resumed run 
+        gets the split back in order by shuffling once with the latest seed (shuffle_seeds).
+        """
         assert split in ['train', 'val', 'test']
-        if seed is not None:
-            random.seed(seed)
-        random.shuffle(self.splits[split])
+        unshuffled = self.unshuffled.setdefault(split, self.splits[split])
+        order = list(range(len(unshuffled)))
+        random.Random(seed).shuffle(order)
+        self.splits[split] = unshuffled[order] if isinstance(unshuffled, np.ndarray) else [unshuffled[i] for i in order]
+        self.shuffle_seeds[split] = seed
+
+
+    def sentence_lengths(self, data):
+        """
+        length in tokens of each sentence in data, for bucketing: the length of the example it gives for formality, and an upper bound 
+        on it for topic. without a tokenized corpus, sentences are tokenized the first time they're needed and their lengths kept.
+        """
+        if self.corpus is not None:
+            return np.diff(np.asarray(self.corpus.maps()['offsets']))[np.asarray(data, dtype=np.int64)]
+        raw_sentences = [example[0] if self.formality else example for example in data]
+        for raw_sentence in raw_sentences:
+            if raw_sentence not in self.token_lengths:
+                self.token_lengths[raw_sentence] = len(self.tokenizer.encode(raw_sentence))
+        return np.array([self.token_lengths[raw_sentence] for raw_sentence in raw_sentences])
 
 
-    def loader(self, split, num_workers=20, indices=None):
+    def loader(self, split, num_workers=20, indices=None, seed=0, shuffle=False, num_replicas=1, rank=0, start=0, length_buckets=False, max_tokens=None):
+        """
+        batches of examples from the split, or from just the given positions in it. seed fixes the random draws for each example
+        and for the workers; see SplitSampler for the rest. start skips that many of the batches, to resume partway through.
+        with length_buckets or max_tokens, batches group similar-length sentences (see BucketBatchSampler). that's only for formality and 
+        topic: the other tasks' examples are short random windows of their sentences, whose lengths the sentences' own don't predict.
+        for topic and rhyme, whose in-batch negatives need the same number of examples in every batch, the sampler pads every split out to 
+        whole batches, so max_tokens isn't allowed; in val and test the copies it pads with get labels of -1, to leave out of the loss.
+        otherwise val and test aren't padded at all. either way each example counts once in their metrics whatever the number of replicas.
+        """
         assert split in ['train', 'val', 'test']
+        assert self.formality or self.topic or not (length_buckets or max_tokens is not None), 'length bucketing is only for formality and topic'
+        assert not (self.topic or self.rhyme) or max_tokens is None, 'topic and rhyme batches need batch_size examples, so no max_tokens'
         data = self.splits[split] if indices is None else [self.splits[split][i] for i in indices]
-        return torch.utils.data.DataLoader(SplitLoader(data, self), batch_size=self.batch_size, pin_memory=True, collate_fn=collate, num_workers=num_workers)
+        dataset = SplitLoader(data, self, seed=seed)
+        generator = torch.Generator()
+        generator.manual_seed(seed) # seeds the workers without drawing from the global torch rng, so a resumed run's rng stays in step
+        full_batches = self.topic or self.rhyme
+        pad = split == 'train' or full_batches
+        mark_padding = split != 'train'
+        if length_buckets or max_tokens is not None:
+            sampler = SplitSampler(len(dataset), shuffle=shuffle, seed=seed, num_replicas=num_replicas, rank=rank, batch_size=self.batch_size if full_batches else None, pad=pad, mark_padding=mark_padding)
+            batch_sampler = BucketBatchSampler(sampler, self.sentence_lengths(data), self.batch_size, max_tokens=max_tokens, seed=seed, start=start)
+            return torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler, pin_memory=True, collate_fn=collate, num_workers=num_workers, generator=generator)
+        sampler = SplitSampler(len(dataset), shuffle=shuffle, seed=seed, num_replicas=num_replicas, rank=rank, start=start * self.batch_size, batch_size=self.batch_size if full_batches else None, pad=pad, mark_padding=mark_padding)
+        return torch.utils.data.DataLoader(dataset, batch_size=self.batch_size, sampler=sampler, pin_memory=True, collate_fn=collate, num_workers=num_workers, generator=generator)
+
+
+class SplitSampler(torch.utils.data.Sampler):
+    """
+    positions into a split, in order or shuffled by seed and epoch, sharded round robin across num_replicas processes (padded by wrapping 
+    around so they all get the same number, and a whole number of batches of batch_size if that's given), and starting from position start 
+    of this replica's share so a run can pick up where it left off. without pad, every position comes up exactly once and the shards
+    can differ in size by one, e.g. so a validation metric doesn't count any example twice. with mark_padding, the copies that pad come 
+    out as position + length instead, so they can be told apart (see SplitLoader).
+    """
+    def __init__(self, length, shuffle=False, seed=0, num_replicas=1, rank=0, start=0, batch_size=None, pad=True, mark_padding=False):
+        self.length = length
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.start = start
+        self.batch_size = batch_size
+        self.pad = pad
+        self.mark_padding = mark_padding
+        self.epoch = 0
+
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+    def replica_length(self):
+        if not self.pad:
+            return len(range(self.rank, self.length, self.num_replicas))
+        replica_length = math.ceil(self.length / self.num_replicas)
+        if self.batch_size is not None:
+            replica_length = math.ceil(replica_length / self.batch_size) * self.batch_size
+        return replica_length
+
+
+    def __len__(self):
+        return max(self.replica_length() - self.start, 0)
+
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.length, generator=generator).tolist()
+        else:
+            order = list(range(self.length))
+        if self.pad:
+            total_length = self.replica_length() * self.num_replicas
+            order = (order * math.ceil(total_length / max(self.length, 1)))[:total_length]
+            if self.mark_padding:
+                order = order[:self.length] + [position + self.length for position in order[self.length:]]
+        return iter(order[self.rank::self.num_replicas][self.start:])
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    batches of positions with similar lengths, to cut padding. takes the sampler's order BUCKET_BATCHES batches' worth at a time, 
+    sorts that chunk by length, and cuts it into batches of batch_size, or of at most max_tokens padded tokens if that's given;
+    the batches of each chunk come out in a random order (by seed and epoch). start skips that many batches, to resume.
+    """
+    def __init__(self, sampler, lengths, batch_size, max_tokens=None, seed=0, start=0):
+        self.sampler = sampler
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.seed = seed
+        self.start = start
+        self.epoch = 0
+
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.sampler.set_epoch(epoch)
+
+
+    def batches(self):
+        rng = random.Random(hash((self.seed, self.epoch)))
+        order = list(self.sampler)
+        batches = []
+        chunk_size = self.batch_size * BUCKET_BATCHES
+        for chunk_start in range(0, len(order), chunk_size):
+            chunk = sorted(order[chunk_start:chunk_start + chunk_size], key=lambda position: self.lengths[position % len(self.lengths)]) # padding copies may be marked
+            chunk_batches, batch, batch_max_length = [], [], 0
+            for position in chunk:
+                length = max(batch_max_length, self.lengths[position % len(self.lengths)])
+                if len(batch) == self.batch_size or (len(batch) > 0 and self.max_tokens is not None and length * (len(batch) + 1) > self.max_tokens):
+                    chunk_batches.append(batch)
+                    batch, length = [], self.lengths[position % len(self.lengths)]
+                batch.append(position)
+                batch_max_length = length
+            if len(batch) > 0:
+                chunk_batches.append(batch)
+            rng.shuffle(chunk_batches)
+            batches += chunk_batches
+        return batches[self.start:]
+
+
+    def __len__(self):
+        return len(self.batches())
+
 
+    def __iter__(self):
+        return iter(self.batches())
 
-class SplitLoader(torch.utils.data.IterableDataset):
-    def __init__(self, data, parent):
+
+class SplitLoader(torch.utils.data.Dataset):
+    """
+    map-style dataset over the examples of a split. the example at index i is built from sentence i with its own random draws,
+    so it doesn't depend on which worker builds it or when; if a draw doesn't give a valid example we draw again from the same sentence.
+    a sentence that gives none in MAX_EXAMPLE_DRAWS draws (e.g. one with no iambic window) is stood in for by a random other one.
+    each example ends with whether it's a copy that just pads out a batch, which the sampler marks as index i + len (see SplitSampler).
+    """
+    def __init__(self, data, parent, seed=0):
         super(SplitLoader).__init__()
         self.data = data
-        self.pos = 0
         self.parent = parent
+        self.seed = seed
 
 
     def __len__(self):
         return len(self.data)
 
 
-    def __iter__(self):
-        return self
-    
-
-    def __next__(self):
-        increment = 1
-        worker_info = torch.utils.data.get_worker_info()
-        if worker_info is not None: # # in a worker process
-            increment = worker_info.num_workers
-            worker_id = worker_info.id
-            if self.pos == 0:
-                self.pos = worker_id
+    def __getitem__(self, index):
+        padding = index >= len(self)
+        index %= len(self)
+        rng = random.Random(hash((self.seed, index)))
+        sentence = index
+        for _ in range(len(self)):
+            for _ in range(MAX_EXAMPLE_DRAWS):
+                example = self.make_example(self.data[sentence], rng)
+                if example is not None:
+                    return example + (padding,)
+            sentence = rng.randrange(len(self)) # this one doesn't seem to have any; stand in a random sentence, so none is favoured
+        raise ValueError('no valid examples in split')
+
+
+    def make_example(self, sentence_example, rng):
+        """
+        try to build a training example from one sentence of the split, drawing random split points etc. from rng. returns None if it's not valid.
+        """
         valid = False
-        while not valid:
-            if self.pos >= len(self):
-                raise StopIteration
-            if self.parent.topic:
-                failed = False
-                future_word_num_syllables, rhyme_group_index, syllables_to_go = -1, -1, -1
-                raw_sentence, classification_label = self.data[self.pos], -1
-                original_sentence = raw_sentence.split()
-                sentence = self.parent.tokenizer.encode(raw_sentence, return_tensors='pt')[0]
-                length = len(sentence)
-                min_sentence_length = MIN_SENTENCE_LENGTH
-                if len(sentence) > min_sentence_length: # set to 3. well, everything in data is > 3 for the bag of words task
-                    pos_to_split = random.randint(1, length - 1) # for lm, learn all positions at once
-                    inp = sentence[:pos_to_split]
-                    length = len(inp)
-                    num_words_in_input = len(self.parent.tokenizer.decode(inp).split())
-                    if not failed and num_words_in_input < len(original_sentence):
-                        future_word_position_max = len(original_sentence) - 1
-                        future_word_position = random.randint(num_words_in_input-1, future_word_position_max) # allow the last possibly partial word though
-                        future_word = original_sentence[future_word_position]
-                        unstripped_future_word = future_word
-                        future_word = future_word.strip().strip(string.punctuation) # NOTE: we didn't strip punctuation for the topic bag of words paper experiments for our method. it doesn't make much difference, though.
-                        if not failed and future_word in self.parent.word2index.keys():
-                            word_log_prob = math.log(self.parent.vocab[future_word] / self.parent.total_words) # roughly baseline prob of word under noise model
-                            future_word = self.parent.word2index[future_word]
-                            pad_id = self.parent.gpt_pad_id
-                            example = (inp, length, future_word, word_log_prob, pad_id, classification_label, syllables_to_go, future_word_num_syllables, rhyme_group_index)
-                            valid = not failed
-            elif self.parent.formality:
-                future_word_num_syllables, rhyme_group_index, syllables_to_go = -1, -1, -1
-                raw_sentence, classification_label = self.data[self.pos]
-                original_sentence = raw_sentence.split()
-                sentence = self.parent.tokenizer.encode(raw_sentence, return_tensors='pt')[0]
-                length = len(sentence)
-                min_sentence_length = MIN_SENTENCE_LENGTH
-                if len(sentence) > min_sentence_length: # set to 3. well, everything in data is > 3 for the bag of words task
-                    pos_to_split = length # no need to split; we're going to train on all possible prefixes simultaneously for efficiency
-                    inp = sentence[:pos_to_split]
-                    length = len(inp)
-                    num_words_in_input = len(self.parent.tokenizer.decode(inp).split())
-                    # only look up to 10 words ahead if we're doing count syllables, since we'll filter out anything more than 10 syllables ahead anyway
+        if self.parent.topic:
+            failed = False
+            future_word_num_syllables, rhyme_group_index, syllables_to_go = -1, -1, -1
+            raw_sentence, classification_label, sentence, word_counts = self.parent.get_sentence(sentence_example)
+            original_sentence = raw_sentence.split()
+            length = len(sentence)
+            min_sentence_length = MIN_SENTENCE_LENGTH
+            if len(sentence) > min_sentence_length: # set to 3. well, everything in data is > 3 for the bag of words task
+                pos_to_split = rng.randint(1, length - 1) # for lm, learn all positions at once
+                inp = sentence[:pos_to_split]
+                length = len(inp)
+                num_words_in_input = self.parent.num_words_in_prefix(sentence, word_counts, pos_to_split)
+                if not failed and num_words_in_input < len(original_sentence):
                     future_word_position_max = len(original_sentence) - 1
-                    future_word_position = 0
-                    future_word = 'placeholder'
+                    future_word_position = rng.randint(num_words_in_input-1, future_word_position_max) # allow the last possibly partial word though
+                    future_word = original_sentence[future_word_position]
                     unstripped_future_word = future_word
                     future_word = future_word.strip().strip(string.punctuation) # NOTE: we didn't strip punctuation for the topic bag of words paper experiments for our method. it doesn't make much difference, though.
+                    if not failed and future_word in self.parent.word2index.keys():
+                        word_log_prob = math.log(self.parent.vocab[future_word] / self.parent.total_words) # roughly baseline prob of word under noise model
+                        future_word = self.parent.word2index[future_word]
+                        pad_id = self.parent.gpt_pad_id
+                        example = (inp, length, future_word, word_log_prob, pad_id, classification_label, syllables_to_go, future_word_num_syllables, rhyme_group_index)
+                        valid = not failed
+        elif self.parent.formality:
+            future_word_num_syllables, rhyme_group_index, syllables_to_go = -1, -1, -1
+            raw_sentence, classification_label, sentence, word_counts = self.parent.get_sentence(sentence_example)
+            original_sentence = raw_sentence.split()
+            length = len(sentence)
+            min_sentence_length = MIN_SENTENCE_LENGTH
+            if len(sentence) > min_sentence_length: # set to 3. well, everything in data is > 3 for the bag of words task
+                pos_to_split = length # no need to split; we're going to train on all possible prefixes simultaneously for efficiency
+                inp = sentence[:pos_to_split]
+                length = len(inp)
+                num_words_in_input = self.parent.num_words_in_prefix(sentence, word_counts, pos_to_split)
+                # only look up to 10 words ahead if we're doing count syllables, since we'll filter out anything more than 10 syllables ahead anyway
+                future_word_position_max = len(original_sentence) - 1
+                future_word_position = 0
+                future_word = 'placeholder'
+                unstripped_future_word = future_word
+                future_word = future_word.strip().strip(string.punctuation) # NOTE: we didn't strip punctuation for the topic bag of words paper experiments for our method. it doesn't make much difference, though.
+                word_log_prob, future_word = 0, 0
+                pad_id = self.parent.gpt_pad_id
+                example = (inp, length, future_word, word_log_prob, pad_id, classification_label, syllables_to_go, future_word_num_syllables, rhyme_group_index)
+                valid = True
+        elif self.parent.iambic:
+            failed = False
+            future_word_num_syllables, rhyme_group_index, syllables_to_go = -1, -1, -1
+            raw_sentence, classification_label, sentence, word_counts = self.parent.get_sentence(sentence_example)
+            original_sentence = raw_sentence.split()
+            length = len(sentence)
+            min_sentence_length = MIN_SENTENCE_LENGTH
+            if len(sentence) > min_sentence_length: # set to 3. well, everything in data is > 3 for the bag of words task
+                pos_to_split = rng.randint(0, length - 1)
+                # try to get a subseq of exactly 10 syllables
+                inp = sentence[pos_to_split:]
+                num_syllables = 0
+                checked = False
+                prefix_syllables = self.parent.prefix_syllables(inp[:-1]) # syllables in each decoded prefix, up to the first one over a line
+                for i in range(1, len(prefix_syllables) + 1):
+                    num_syllables = prefix_syllables[i-1]
+                    if num_syllables > POETRY_LINE_SYLLABLES:
+                        inp = inp[:i-1] # might get a few data points where the split is in the middle of a word, but it should be ok for learning. 
+                        last_line_length = i-1
+                        num_syllables = prefix_syllables[i-2] if i > 1 else 0
+                        checked = True
+                        break
+                if not checked or num_syllables != POETRY_LINE_SYLLABLES:
+                    failed = True
+                length = len(inp)
+                decoded = self.parent.tokenizer.decode(inp)
+                num_words_in_input = len(decoded.split())
+                classification_label = [is_iambic(decoded) for _ in range(length)] # predict for whole seq including future
+                # only look up to 10 words ahead if we're doing count syllables, since we'll filter out anything more than 10 syllables ahead anyway
+                future_word_position_max = len(original_sentence) - 1
+                future_word_position = 0
+                future_word = 'placeholder'
+                unstripped_future_word = future_word
+                future_word = future_word.strip().strip(string.punctuation) # NOTE: we didn't strip punctuation for the topic bag of words paper experiments for our method. it doesn't make much difference, though.
+                if not failed:
                     word_log_prob, future_word = 0, 0
                     pad_id = self.parent.gpt_pad_id
                     example = (inp, length, future_word, word_log_prob, pad_id, classification_label, syllables_to_go, future_word_num_syllables, rhyme_group_index)
-                    valid = True
-            elif self.parent.iambic:
-                failed = False
-                future_word_num_syllables, rhyme_group_index, syllables_to_go = -1, -1, -1
-                raw_sentence, classification_label = self.data[self.pos], -1
-                original_sentence = raw_sentence.split()
-                sentence = self.parent.tokenizer.encode(raw_sentence, return_tensors='pt')[0]
-                length = len(sentence)
-                min_sentence_length = MIN_SENTENCE_LENGTH
-                if len(sentence) > min_sentence_length: # set to 3. well, everything in data is > 3 for the bag of words task
-                    pos_to_split = random.randint(0, length - 1)
-                    # try to get a subseq of exactly 10 syllables
-                    inp = sentence[pos_to_split:]
-                    num_syllables = 0
-                    checked = False
-                    for i in range(1, len(inp)):
-                        decoded = self.parent.tokenizer.decode(inp[:i])
-                        num_syllables = count_syllables(decoded)
-                        if num_syllables > POETRY_LINE_SYLLABLES:
-                            inp = inp[:i-1] # might get a few data points where the split is in the middle of a word, but it should be ok for learning. 
-                            last_line_length = i-1
-                            decoded = self.parent.tokenizer.decode(inp)
-                            num_syllables = count_syllables(decoded)
-                            checked = True
-                            break
-                    if not checked or num_syllables != POETRY_LINE_SYLLABLES:
+                    valid = not failed
+        elif self.parent.rhyme:
+            failed = False
+            future_word_num_syllables, rhyme_group_index = -1, -1
+            raw_sentence, classification_label, sentence, word_counts = self.parent.get_sentence(sentence_example)
+            original_sentence = raw_sentence.split()
+            length = len(sentence)
+            min_sentence_length = MIN_SENTENCE_LENGTH
+            if len(sentence) > min_sentence_length: # set to 3. well, everything in data is > 3 for the bag of words task
+                pos_to_split = rng.randint(1, length - 1) # for lm, learn all positions at once
+                inp = sentence[:pos_to_split]
+                length = len(inp)
+                num_words_in_input = self.parent.num_words_in_prefix(sentence, word_counts, pos_to_split)
+                if not failed and num_words_in_input < len(original_sentence):
+                    # only look up to 10 words ahead if we're doing count syllables, since we'll filter out anything more than 10 syllables ahead anyway
+                    future_word_position_max = min(len(original_sentence) - 1, num_words_in_input + MAX_COUNT_SYLLABLE_DIST)
+                    future_word_position = rng.randint(num_words_in_input-1, future_word_position_max) # allow the last possibly partial word though
+                    future_word = original_sentence[future_word_position]
+                    unstripped_future_word = future_word
+                    future_word = future_word.strip().strip(string.punctuation) # NOTE: we didn't strip punctuation for the topic bag of words paper experiments for our method. it doesn't make much difference, though.
+                                                    
+                    words_in_between = original_sentence[num_words_in_input-1:future_word_position+1]
+                    syllables_to_go = count_syllables(' '.join(words_in_between))
+                    if syllables_to_go > MAX_COUNT_SYLLABLE_DIST:
                         failed = True
+                    future_word_num_syllables = count_syllables(future_word)
+                    rhyme_group = self.parent.word2rhyme_group[future_word]
+                    rhyme_group_index = self.parent.rhyme_group2index[rhyme_group]
+                    # truncate context a bit since we're just doing couplets. random length from 1 to max desired length for this purpose. 
+                    desired_length = rng.randint(1, MAX_COUNT_SYLLABLE_INPUT_LENGTH)
+                    inp = inp[-desired_length:]
                     length = len(inp)
-                    num_words_in_input = len(self.parent.tokenizer.decode(inp).split())
-                    classification_label = [is_iambic(self.parent.tokenizer.decode(inp)) for _ in range(length)] # predict for whole seq including future
+
+                    if not failed and future_word in self.parent.word2index.keys():
+                        word_log_prob = math.log(self.parent.rhyme_group_counts[rhyme_group] / self.parent.total_rhyme_groups)
+                        future_word = rhyme_group_index # future conditioning is just the rhyme group in this case
+                        pad_id = self.parent.gpt_pad_id
+                        example = (inp, length, future_word, word_log_prob, pad_id, classification_label, syllables_to_go, future_word_num_syllables, rhyme_group_index)
+                        valid = not failed
+        elif self.parent.newline:
+            failed = False
+            future_word_num_syllables, rhyme_group_index = -1, -1
+            raw_sentence, classification_label, sentence, word_counts = self.parent.get_sentence(sentence_example)
+            original_sentence = raw_sentence.split()
+            length = len(sentence)
+            min_sentence_length = MIN_SENTENCE_LENGTH
+            if len(sentence) > min_sentence_length: # set to 3. well, everything in data is > 3 for the bag of words task
+                pos_to_split = rng.randint(1, length - 1) # for lm, learn all positions at once
+                pos_to_split = self.parent.next_word_boundary(sentence, word_counts, pos_to_split) # extend to the end of the current word
+                inp = sentence[:pos_to_split]
+                length = len(inp)
+                num_words_in_input = self.parent.num_words_in_prefix(sentence, word_counts, pos_to_split)
+                if not failed and num_words_in_input < len(original_sentence):
                     # only look up to 10 words ahead if we're doing count syllables, since we'll filter out anything more than 10 syllables ahead anyway
                     future_word_position_max = len(original_sentence) - 1
-                    future_word_position = 0
-                    future_word = 'placeholder'
+                    future_word_position = rng.randint(num_words_in_input-1, future_word_position_max) # allow the last possibly partial word though
+                    future_word = original_sentence[future_word_position]
                     unstripped_future_word = future_word
                     future_word = future_word.strip().strip(string.punctuation) # NOTE: we didn't strip punctuation for the topic bag of words paper experiments for our method. it doesn't make much difference, though.
-                    if not failed:
-                        word_log_prob, future_word = 0, 0
+                                                    
+                    # future_word = original_sentence[-1] # useful for debugging
+                    words_in_between = original_sentence[num_words_in_input-1:future_word_position+1]
+                    syllables_to_go = count_syllables(' '.join(words_in_between))
+                    if syllables_to_go > MAX_COUNT_SYLLABLE_DIST:
+                        failed = True
+                    # truncate context a bit since we're just doing couplets. random length from 1 to max desired length for this purpose. 
+                    desired_length = rng.randint(1, MAX_COUNT_SYLLABLE_INPUT_LENGTH)
+                    # desired_length = 10 # useful for debugging
+                    inp = inp[-desired_length:]
+                    length = len(inp)
+                    true_label = 1 if unstripped_future_word.strip()[-1] in PHRASE_ENDS else 0 # common ways to end a phrase
+                    classification_label = [-1 for _ in range(length)]
+                    classification_label[-1] = true_label # only learn at the last position
+                    if not failed and future_word in self.parent.word2index.keys():
+                        word_log_prob = math.log(self.parent.vocab[future_word] / self.parent.total_words) # roughly baseline prob of word under noise model
+                        future_word = self.parent.word2index[future_word]
                         pad_id = self.parent.gpt_pad_id
                         example = (inp, length, future_word, word_log_prob, pad_id, classification_label, syllables_to_go, future_word_num_syllables, rhyme_group_index)
                         valid = not failed
-            elif self.parent.rhyme:
-                failed = False
-                future_word_num_syllables, rhyme_group_index = -1, -1
-                raw_sentence, classification_label = self.data[self.pos], -1
-                original_sentence = raw_sentence.split()
-                sentence = self.parent.tokenizer.encode(raw_sentence, return_tensors='pt')[0]
-                length = len(sentence)
-                min_sentence_length = MIN_SENTENCE_LENGTH
-                if len(sentence) > min_sentence_length: # set to 3. well, everything in data is > 3 for the bag of words task
-                    pos_to_split = random.randint(1, length - 1) # for lm, learn all positions at once
-                    inp = sentence[:pos_to_split]
-                    length = len(inp)
-                    num_words_in_input = len(self.parent.tokenizer.decode(inp).split())
-                    if not failed and num_words_in_input < len(original_sentence):
-                        # only look up to 10 words ahead if we're doing count syllables, since we'll filter out anything more than 10 syllables ahead anyway
-                        future_word_position_max = min(len(original_sentence) - 1, num_words_in_input + MAX_COUNT_SYLLABLE_DIST)
-                        future_word_position = random.randint(num_words_in_input-1, future_word_position_max) # allow the last possibly partial word though
-                        future_word = original_sentence[future_word_position]
-                        unstripped_future_word = future_word
-                        future_word = future_word.strip().strip(string.punctuation) # NOTE: we didn't strip punctuation for the topic bag of words paper experiments for our method. it doesn't make much difference, though.
-                                                        
-                        words_in_between = original_sentence[num_words_in_input-1:future_word_position+1]
-                        syllables_to_go = count_syllables(' '.join(words_in_between))
-                        if syllables_to_go > MAX_COUNT_SYLLABLE_DIST:
-                            failed = True
-                        future_word_num_syllables = count_syllables(future_word)
-                        rhyme_group = self.parent.word2rhyme_group[future_word]
-                        rhyme_group_index = self.parent.rhyme_group2index[rhyme_group]
-                        # truncate context a bit since we're just doing couplets. random length from 1 to max desired length for this purpose. 
-                        desired_length = random.randint(1, MAX_COUNT_SYLLABLE_INPUT_LENGTH)
-                        inp = inp[-desired_length:]
-                        length = len(inp)
-
-                        if not failed and future_word in self.parent.word2index.keys():
-                            word_log_prob = math.log(self.parent.rhyme_group_counts[rhyme_group] / self.parent.total_rhyme_groups)
-                            future_word = rhyme_group_index # future conditioning is just the rhyme group in this case
-                            pad_id = self.parent.gpt_pad_id
-                            example = (inp, length, future_word, word_log_prob, pad_id, classification_label, syllables_to_go, future_word_num_syllables, rhyme_group_index)
-                            valid = not failed
-            elif self.parent.newline:
-                failed = False
-                future_word_num_syllables, rhyme_group_index = -1, -1
-                raw_sentence, classification_label = self.data[self.pos], -1
-                original_sentence = raw_sentence.split()
-                sentence = self.parent.tokenizer.encode(raw_sentence, return_tensors='pt')[0]
-                length = len(sentence)
-                min_sentence_length = MIN_SENTENCE_LENGTH
-                if len(sentence) > min_sentence_length: # set to 3. well, everything in data is > 3 for the bag of words task
-                    pos_to_split = random.randint(1, length - 1) # for lm, learn all positions at once
-                    inp = sentence[:pos_to_split]
-                    while pos_to_split < len(sentence):
-                        if len(self.parent.tokenizer.decode(inp).split()) == len(self.parent.tokenizer.decode(sentence[:pos_to_split + 1]).split()):
-                            pos_to_split += 1
-                            inp = sentence[:pos_to_split]
-                        else:
-                            break
-                    length = len(inp)
-                    num_words_in_input = len(self.parent.tokenizer.decode(inp).split())
-                    if not failed and num_words_in_input < len(original_sentence):
-                        # only look up to 10 words ahead if we're doing count syllables, since we'll filter out anything more than 10 syllables ahead anyway
-                        future_word_position_max = len(original_sentence) - 1
-                        future_word_position = random.randint(num_words_in_input-1, future_word_position_max) # allow the last possibly partial word though
-                        future_word = original_sentence[future_word_position]
-                        unstripped_future_word = future_word
-                        future_word = future_word.strip().strip(string.punctuation) # NOTE: we didn't strip punctuation for the topic bag of words paper experiments for our method. it doesn't make much difference, though.
-                                                        
-                        # future_word = original_sentence[-1] # useful for debugging
-                        words_in_between = original_sentence[num_words_in_input-1:future_word_position+1]
-                        syllables_to_go = count_syllables(' '.join(words_in_between))
-                        if syllables_to_go > MAX_COUNT_SYLLABLE_DIST:
-                            failed = True
-                        # truncate context a bit since we're just doing couplets. random length from 1 to max desired length for this purpose. 
-                        desired_length = random.randint(1, MAX_COUNT_SYLLABLE_INPUT_LENGTH)
-                        # desired_length = 10 # useful for debugging
-                        inp = inp[-desired_length:]
-                        length = len(inp)
-                        true_label = 1 if unstripped_future_word.strip()[-1] in PHRASE_ENDS else 0 # common ways to end a phrase
-                        classification_label = [-1 for _ in range(length)]
-                        classification_label[-1] = true_label # only learn at the last position
-                        if not failed and future_word in self.parent.word2index.keys():
-                            word_log_prob = math.log(self.parent.vocab[future_word] / self.parent.total_words) # roughly baseline prob of word under noise model
-                            future_word = self.parent.word2index[future_word]
-                            pad_id = self.parent.gpt_pad_id
-                            example = (inp, length, future_word, word_log_prob, pad_id, classification_label, syllables_to_go, future_word_num_syllables, rhyme_group_index)
-                            valid = not failed
-            else:
-                raise NotImplementedError
+        else:
+            raise NotImplementedError
 
-            self.pos += increment
-        return example
\ No newline at end of file
+        return example if valid else None
\ No newline at end of file
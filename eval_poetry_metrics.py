@@ -8,7 +8,7 @@ import torch
 import torch.nn.functional as F
 from transformers import AutoTokenizer, AutoModelWithLMHead, AutoModelForSequenceClassification
 
-from poetry_util import is_iambic, perfect_rhyme_end, count_syllables
+from poetry_util import is_iambic, perfect_rhyme_end, count_syllables, load_phonetics_table
 from constants import *
 
 
@@ -59,8 +59,12 @@ if __name__=='__main__':
     parser.add_argument('--pred_file', type=str)
     parser.add_argument('--prefix_file', type=str)
     parser.add_argument('--device', type=str, default='cuda', choices=['cpu', 'cuda'])
+    parser.add_argument('--phonetics_table', type=str, default=None, help='precompiled phonetics from poetry_util.py, to speed up syllable/stress/rhyme lookups')
     args = parser.parse_args()
 
+    if args.phonetics_table is not None:
+        load_phonetics_table(args.phonetics_table)
+
     preds = []
     with open(args.pred_file, 'r') as rf:
         for line in rf:
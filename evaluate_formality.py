@@ -60,18 +60,28 @@ def main(args):
         for line in rf:
             inputs.append(line.strip())
     
-    for inp in tqdm(inputs, total=len(inputs)):
-        results = predict_formality(model, 
+    # translate similar-length sentences together to cut padding, then print in the original order
+    order = sorted(range(len(inputs)), key=lambda i: len(inputs[i]))
+    results = [None for _ in inputs]
+    for i in tqdm(range(0, len(order), args.batch_size), total=math.ceil(len(order) / args.batch_size)):
+        batch_indices = order[i:i + args.batch_size]
+        batch_results = predict_formality(model, 
                         tokenizer, 
                         conditioning_model, 
-                        [inp], 
+                        [inputs[j] for j in batch_indices], 
                         dataset_info, 
                         precondition_topk=args.precondition_topk,
                         do_sample=args.do_sample,
                         length_cutoff=args.length_cutoff,
                         condition_lambda=args.condition_lambda,
-                        device=args.device)
-        print(results[0])
+                        device=args.device,
+                        topk=args.topk,
+                        top_p=args.top_p,
+                        num_beams=args.num_beams)
+        for j, result in zip(batch_indices, batch_results):
+            results[j] = result
+    for result in results:
+        print(result)
 
 
 if __name__=='__main__':
@@ -86,7 +96,11 @@ if __name__=='__main__':
     parser.add_argument('--in_file', type=str, default=None, required=True, help='file containing text to run pred on')
 
     parser.add_argument('--precondition_topk', type=int, default=200, help='consider top k outputs from gpt at each step before conditioning and re-pruning')
-    parser.add_argument('--do_sample', action='store_true', default=False, help='sample or greedy; only greedy implemented')
+    parser.add_argument('--batch_size', type=int, default=32, help='number of sentences to translate at once')
+    parser.add_argument('--do_sample', action='store_true', default=False, help='sample instead of greedy')
+    parser.add_argument('--topk', type=int, default=0, help='when sampling, only sample from the top k reweighted candidates; 0 for all of them')
+    parser.add_argument('--top_p', type=float, default=1.0, help='when sampling, only sample from the smallest set of reweighted candidates with this much probability')
+    parser.add_argument('--num_beams', type=int, default=1, help='beam search over the fudge-reweighted distribution with this many beams if > 1')
     parser.add_argument('--condition_lambda', type=float, default=1.0, help='lambda weight on conditioning model')
     parser.add_argument('--length_cutoff', type=int, default=512, help='max length')
 
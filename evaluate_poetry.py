@@ -18,10 +18,12 @@ from data import Dataset, load_rhyme_info
 from model import Model
 from util import save_checkpoint, ProgressMeter, AverageMeter, num_params
 from constants import *
-from poetry_util import get_rhymes, count_syllables
-from predict_poetry import predict_couplet
+from poetry_util import get_rhymes, count_syllables, load_phonetics_table
+from predict_poetry import predict_couplets
 
 def main(args):
+    if args.phonetics_table is not None:
+        load_phonetics_table(args.phonetics_table)
     with open(args.dataset_info, 'rb') as rf:
         dataset_info = pickle.load(rf)
     gpt_tokenizer = AutoTokenizer.from_pretrained(args.model_string)
@@ -67,21 +69,23 @@ def main(args):
 
     with open(args.prefix_file, 'r') as rf:
         lines = rf.readlines()
-    for line in tqdm(lines, total=len(lines)):
-        couplet = predict_couplet(gpt_model, 
+    for i in tqdm(range(0, len(lines), args.batch_size), total=math.ceil(len(lines) / args.batch_size)):
+        couplets = predict_couplets(gpt_model, 
                 gpt_tokenizer, 
                 iambic_model, 
                 rhyme_model,
                 newline_model,
-                [line], 
+                lines[i:i + args.batch_size], 
                 dataset_info, 
                 rhyme_info,
                 args.precondition_topk,
                 args.topk, 
                 condition_lambda=args.condition_lambda,
-                device=args.device)
-        assert len(couplet) == 2
-        print(couplet[1].strip().replace('\n', ''))
+                device=args.device,
+                predictor_threads=args.predictor_threads)
+        for couplet in couplets:
+            assert len(couplet) == 2
+            print(couplet[1].strip().replace('\n', ''))
 
 
 if __name__=='__main__':
@@ -93,6 +97,7 @@ if __name__=='__main__':
     parser.add_argument('--newline_ckpt', type=str, required=True)
     parser.add_argument('--dataset_info', type=str, required=True, help='saved dataset info')
     parser.add_argument('--rhyme_info', type=str, required=True, help='saved rhyme info')
+    parser.add_argument('--phonetics_table', type=str, default=None, help='precompiled phonetics from poetry_util.py, to speed up syllable/stress/rhyme lookups')
     parser.add_argument('--model_string', type=str, default='gpt2-medium')
 
     parser.add_argument('--prefix_file', type=str, default=None, required=True, help='file of prefix lines for couplets')
@@ -100,6 +105,8 @@ if __name__=='__main__':
     parser.add_argument('--precondition_topk', type=int, default=200, help='consider top k outputs from gpt at each step before conditioning and re-pruning')
     parser.add_argument('--topk', type=int, default=10, help='consider top k outputs from gpt at each step')
     parser.add_argument('--condition_lambda', type=float, default=1.0, help='lambda weight on conditioning model')
+    parser.add_argument('--batch_size', type=int, default=1, help='number of prefixes to generate couplets for at once')
+    parser.add_argument('--predictor_threads', type=int, default=1, help='run the iambic, rhyme, and newline predictors concurrently on this many threads')
 
     parser.add_argument('--seed', type=int, default=1, help='random seed')
     parser.add_argument('--device', type=str, default='cuda', choices=['cpu', 'cuda'])
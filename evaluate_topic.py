@@ -76,28 +76,27 @@ def main(args):
                 conditions.append(c)
                 categories.append(category)
     
-    all_cr = []
-    pair_num = 0
-    for input_text, condition_words, category in tqdm(zip(input_texts, conditions, categories), total=len(conditions)):
-        predict_function = predict
-        condition_results = []
-        for i in range(0, args.sample_size, args.max_sample_batch):
-            num_samples = min(args.max_sample_batch, args.sample_size - i)
-            condition_results += predict_function(gpt_model, 
-                            gpt_tokenizer, 
-                            conditioning_model, 
-                            [input_text for _ in range(num_samples)],
-                            condition_words,
-                            dataset_info, 
-                            args.precondition_topk,
-                            args.topk, 
-                            args.length_cutoff,
-                            condition_lambda=args.condition_lambda,
-                            device=args.device)
-        all_cr.append((input_text, category, condition_results))
-        pair_num += 1
-        if args.max_pairs > 0 and pair_num >= args.max_pairs:
-            break
+    if args.max_pairs > 0:
+        input_texts, conditions, categories = input_texts[:args.max_pairs], conditions[:args.max_pairs], categories[:args.max_pairs]
+    # flatten every (input text, condition) pair x sample into one list of rows, so a batch can mix prompts and wordlists
+    rows = [pair_index for pair_index in range(len(input_texts)) for _ in range(args.sample_size)]
+    all_cr = [(input_text, category, []) for input_text, category in zip(input_texts, categories)]
+    for i in tqdm(range(0, len(rows), args.max_sample_batch), total=math.ceil(len(rows) / args.max_sample_batch)):
+        batch_rows = rows[i:i + args.max_sample_batch]
+        batch_results = predict(gpt_model, 
+                        gpt_tokenizer, 
+                        conditioning_model, 
+                        [input_texts[pair_index] for pair_index in batch_rows],
+                        [conditions[pair_index] for pair_index in batch_rows],
+                        dataset_info, 
+                        args.precondition_topk,
+                        args.topk, 
+                        args.length_cutoff,
+                        condition_lambda=args.condition_lambda,
+                        device=args.device,
+                        use_cache=not args.no_cache)
+        for pair_index, result in zip(batch_rows, batch_results):
+            all_cr[pair_index][2].append(result)
     with open(args.log_file, 'w') as wf:
         writer = csv.DictWriter(wf, fieldnames=['category', 'input_text', 'generation'])
         writer.writeheader()
@@ -119,13 +118,14 @@ if __name__=='__main__':
     parser.add_argument('--prefix_file', type=str, default=None, help='prefix set')
     parser.add_argument('--wordlist_dir', type=str, default=None, help='dir of bow wordlists for categories')
     parser.add_argument('--sample_size', type=int, default=3, help='samples per input text-condition pair')
-    parser.add_argument('--max_sample_batch', type=int, default=3, help='max samples at a time')
+    parser.add_argument('--max_sample_batch', type=int, default=3, help='max samples at a time; a batch can mix different input text-condition pairs')
     parser.add_argument('--max_pairs', type=int, default=-1, help='max input-condition pairs, for debugging quickly')
 
     parser.add_argument('--precondition_topk', type=int, default=200, help='consider top k outputs from gpt at each step before conditioning and re-pruning')
     parser.add_argument('--topk', type=int, default=10, help='consider top k outputs from gpt at each step')
     parser.add_argument('--condition_lambda', type=float, default=1.0, help='lambda weight on conditioning model')
     parser.add_argument('--length_cutoff', type=int, default=80, help='max length')
+    parser.add_argument('--no_cache', action='store_true', default=False, help='rerun gpt on the full prefix every step instead of reusing past_key_values; slower, same outputs')
 
     parser.add_argument('--seed', type=int, default=1, help='random seed')
     parser.add_argument('--device', type=str, default='cuda', choices=['cpu', 'cuda'])
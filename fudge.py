@@ -0,0 +1,416 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import torch
+import torch.nn.functional as F
+from transformers import LogitsProcessor, LogitsProcessorList, NoBadWordsLogitsProcessor, ForcedEOSTokenLogitsProcessor, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+from transformers.generation.beam_search import BeamHypotheses
+
+from util import right_pad_tokens, select_rows
+from constants import *
+
+
+class FudgeLogitsProcessor(LogitsProcessor):
+    """
+    fudge as a logits processor, for generate below or huggingface's own generate (greedy, sampling, or beam search; gpt2 or marian).
+    keeps each row's precondition_topk most likely next tokens under the base model, and adds the weighted sum of the
+    predictors' log probs of their attributes to each of them; every other token gets -inf.
+    predictors: list of (predictor, condition_lambda). predictor(input_ids, candidates, rows) gives its log probs, rows x K, 
+        for the candidates (token ids, rows x K) following input_ids (rows x seq); rows are the indices of those rows in the 
+        generate batch (batch * num_beams, each example's beams consecutive), for predictors with per-example inputs.
+    exact_topk: if only the top exact_topk reweighted scores of each row matter (1 for greedy, top_k when sampling with top_k,
+        2 * num_beams for beam search), score the candidates in batches in order of the base model's score, starting from
+        precondition_topk / PRUNING_CHUNKS and doubling, and stop once no remaining candidate could make a row's top exact_topk.
+        the predictors' log probs are <= 0, so with lambdas >= 0 the base model's score bounds a candidate's full score; 
+        the top exact_topk come out the same as if every candidate was scored.
+        None to score every candidate.
+    finished: function from input_ids to which rows are already done (batch bools), for huggingface's generate, which keeps 
+        finished rows in the batch; they skip the predictors. generate below drops them from the batch instead.
+    executor: e.g. a ThreadPoolExecutor to run the predictors concurrently, after fusing those that can share a model call 
+        (see fuse_predictors); None to run them one after another.
+    """
+    def __init__(self, predictors, precondition_topk=200, exact_topk=None, finished=None, executor=None):
+        predictors = [(predictor, condition_lambda) for predictor, condition_lambda in predictors if condition_lambda != 0]
+        self.bounded = all(condition_lambda > 0 for _, condition_lambda in predictors) # no bound if a lambda < 0
+        self.predictors = fuse_predictors(predictors)
+        self.precondition_topk = precondition_topk
+        self.exact_topk = exact_topk
+        self.finished = finished
+        self.executor = executor
+
+
+    def condition_logits(self, input_ids, candidates, rows):
+        if self.executor is None or len(self.predictors) == 1:
+            return sum(condition_lambda * predictor(input_ids, candidates, rows) for predictor, condition_lambda in self.predictors)
+        futures = [self.executor.submit(predictor, input_ids, candidates, rows) for predictor, _ in self.predictors]
+        return sum(condition_lambda * future.result() for future, (_, condition_lambda) in zip(futures, self.predictors))
+
+
+    def __call__(self, input_ids, scores):
+        return self.process(input_ids, scores, torch.arange(input_ids.shape[0]).to(input_ids.device))
+
+
+    def process(self, input_ids, scores, rows):
+        """
+        rows: the generate batch index of each row of input_ids, which generate below needs once it has dropped rows from the batch
+        """
+        top_logits, top_indices = scores.topk(self.precondition_topk, dim=1) # batch x topk, best first
+        active = torch.arange(input_ids.shape[0]).to(input_ids.device) # rows of input_ids to score
+        if self.finished is not None:
+            active = active[~self.finished(input_ids)]
+        if len(self.predictors) == 0 or len(active) == 0:
+            full_logits = top_logits
+        elif self.exact_topk is None or not self.bounded:
+            full_logits = top_logits.clone()
+            full_logits[active] += self.condition_logits(input_ids[active], top_indices[active], rows[active])
+        else:
+            full_logits = top_logits.clone()
+            full_logits[active] = -float('inf') # filled in as candidates are scored
+            start, chunk_size = 0, max(self.exact_topk, self.precondition_topk // PRUNING_CHUNKS)
+            while len(active) > 0: # rows that still need more candidates scored
+                end = min(start + chunk_size, self.precondition_topk)
+                condition_logits = self.condition_logits(input_ids[active], top_indices[active, start:end], rows[active]) # rows x chunk
+                full_logits[active, start:end] = top_logits[active, start:end] + condition_logits
+                if end == self.precondition_topk:
+                    break
+                start, chunk_size = end, 2 * chunk_size
+                kth_best = full_logits[active].topk(self.exact_topk, dim=1)[0][:, -1]
+                active = active[top_logits[active, start] > kth_best] # the next candidate could still make the top exact_topk
+        return torch.full_like(scores, -float('inf')).scatter(1, top_indices, full_logits)
+
+
+def fuse_predictors(predictors):
+    """
+    merges the predictors that can share one model call, e.g. several topics under the same topic model, which scores any number of
+    words in one pass over each candidate text. a predictor class opts in with fuse_key(), equal for predictors it can fuse (None if 
+    it can't), and a fuse(predictors) staticmethod making one predictor that gives the weighted sum of a list of (predictor, condition_lambda).
+    predictors: list of (predictor, condition_lambda)
+    returns: list of (predictor, condition_lambda), with each fused group as one predictor weighted by 1
+    """
+    groups = {} # (class, fuse key), or a new int for a predictor that doesn't fuse -> list of (predictor, condition_lambda); in order of first appearance
+    for predictor, condition_lambda in predictors:
+        key = predictor.fuse_key() if hasattr(predictor, 'fuse_key') else None
+        groups.setdefault((type(predictor), key) if key is not None else len(groups), []).append((predictor, condition_lambda))
+    return [group[0] if len(group) == 1 else (type(group[0][0]).fuse(group), 1.0) for group in groups.values()]
+
+
+class RowMaxLength:
+    """
+    stopping criterion for generate: each row is done once it has max_length tokens, not counting its left padding (num_pad; batch)
+    """
+    def __init__(self, max_length, num_pad):
+        self.max_length = max_length
+        self.num_pad = num_pad
+
+
+    def __call__(self, input_ids, rows):
+        return input_ids.shape[1] - self.num_pad[rows] >= self.max_length
+
+
+def left_pad_prompts(prompts, device):
+    """
+    prompts (lists of token ids) for a decoder-only base model, left-padded with 0s so they all end at the last position.
+    returns: token ids, batch x seq; attention mask hiding the padding, batch x seq; and the amount of padding in each row, batch
+    """
+    lengths = torch.LongTensor([len(prompt) for prompt in prompts]).to(device) # batch
+    num_pad = lengths.max() - lengths # batch
+    input_ids = torch.LongTensor([[0 for _ in range(npad)] + prompt for npad, prompt in zip(num_pad.tolist(), prompts)]).to(device) # batch x seq
+    attention_mask = (torch.arange(input_ids.shape[1]).to(device).unsqueeze(0) >= num_pad.unsqueeze(1)).long() # batch x seq
+    return input_ids, attention_mask, num_pad
+
+
+class Decoder:
+    """
+    the base model's side of generate: its next token logits for the active rows, with its kv cache (and encoder outputs) kept in step 
+    as rows are reordered or dropped.
+    input_ids: left-padded prompts for a decoder-only model, with their attention_mask; or sources for an encoder-decoder one,
+        which get encoded once, and the decoder starts from decoder_start_token_id
+    """
+    def __init__(self, model, input_ids, attention_mask, decoder_start_token_id=None, use_cache=True):
+        self.model = model
+        self.use_cache = use_cache
+        self.attention_mask = attention_mask if attention_mask is not None else torch.ones_like(input_ids)
+        self.past = None
+        if model.config.is_encoder_decoder:
+            self.encoder_hidden = model.get_encoder()(input_ids, attention_mask=self.attention_mask)[0] # batch x seq x hidden
+            self.input_ids = torch.full((input_ids.shape[0], 1), decoder_start_token_id, dtype=torch.long, device=input_ids.device)
+        else:
+            self.input_ids = input_ids
+
+
+    def logits(self):
+        """
+        next token logits of each row; rows x vocab
+        """
+        new_ids = self.input_ids if self.past is None else self.input_ids[:, -1:] # the cache has everything else
+        if self.model.config.is_encoder_decoder:
+            outputs = self.model(encoder_outputs=(self.encoder_hidden,), attention_mask=self.attention_mask, decoder_input_ids=new_ids, past_key_values=self.past, use_cache=self.use_cache)
+        else:
+            position_ids = (self.attention_mask.cumsum(dim=1) - 1).masked_fill(self.attention_mask == 0, 1) # left padding doesn't move the positions
+            outputs = self.model(input_ids=new_ids, attention_mask=self.attention_mask, position_ids=position_ids[:, -new_ids.shape[1]:], past_key_values=self.past, use_cache=self.use_cache)
+        if self.use_cache:
+            self.past = outputs.past_key_values
+        return outputs.logits[:, -1].float()
+
+
+    def append(self, rows, tokens):
+        """
+        continue the given rows (which can repeat, for beam search) with the given tokens; rows
+        """
+        self.input_ids = torch.cat([self.input_ids[rows], tokens.unsqueeze(1)], dim=1)
+        self.past = select_rows(self.past, rows)
+        if self.model.config.is_encoder_decoder:
+            self.encoder_hidden, self.attention_mask = self.encoder_hidden[rows], self.attention_mask[rows]
+        else:
+            self.attention_mask = torch.cat([self.attention_mask[rows], self.attention_mask.new_ones((len(rows), 1))], dim=1)
+
+
+    def select(self, rows):
+        """
+        keep just the given rows in the batch, e.g. dropping finished ones; they can repeat, e.g. to give each example num_beams rows
+        """
+        self.input_ids = self.input_ids[rows]
+        self.past = select_rows(self.past, rows)
+        self.attention_mask = self.attention_mask[rows]
+        if self.model.config.is_encoder_decoder:
+            self.encoder_hidden = self.encoder_hidden[rows]
+
+
+def generate(model, input_ids, predictors, precondition_topk=200, stopping_criteria=None, predictor_threads=1, attention_mask=None, 
+             max_length=None, max_new_tokens=None, do_sample=False, top_k=0, top_p=1.0, temperature=1.0, num_beams=1, length_penalty=1.0, 
+             early_stopping=False, bad_words_ids=None, eos_token_id=None, forced_eos_token_id=None, decoder_start_token_id=None, use_cache=True):
+    """
+    fudge decoding with any huggingface base model: greedy, sampling, or beam search as in huggingface's generate, with the predictors 
+    added to the base model's scores each step by a FudgeLogitsProcessor. rows (or with beam search, examples) that are done are dropped
+    from the batch, along with their kv cache, so they cost neither the base model nor the predictors anything from then on.
+    input_ids: left-padded prompts for a decoder-only model (see left_pad_prompts), or sources for an encoder-decoder one; batch x seq
+    attention_mask: hides the padding of input_ids; batch x seq
+    predictors: list of (predictor, condition_lambda); see FudgeLogitsProcessor. rows are indices into the batch (batch * num_beams 
+        with beam search), whichever rows are left.
+    stopping_criteria: list of functions (input_ids, rows) -> which of those rows are done (bools), e.g. the end of a poetry line.
+        they're also checked before the first step, so rows can be done from the start. not for beam search.
+    predictor_threads: run up to this many predictors at once on a thread pool. torch releases the gil inside its ops, so this helps
+        when there are several predictors that each leave the device underused, e.g. small batches on a gpu.
+    max_length: the most tokens in a row (including the prompt, or the decoder start token); or max_new_tokens: the most tokens to add
+    do_sample, top_k, top_p, temperature, num_beams, length_penalty, early_stopping, bad_words_ids, forced_eos_token_id: as in huggingface's 
+        generate. a row is done after eos_token_id if it's set.
+    returns: for each row (with beam search, each example's best hypothesis), its token ids through the token where it was done, 
+        including the prompt (decoder-only) or the decoder start token (encoder-decoder)
+    """
+    batch_size = input_ids.shape[0]
+    decoder = Decoder(model, input_ids, attention_mask, decoder_start_token_id=decoder_start_token_id, use_cache=use_cache)
+    if max_length is None:
+        max_length = decoder.input_ids.shape[1] + max_new_tokens
+    if num_beams > 1:
+        assert not do_sample, 'beam search is only implemented without sampling'
+        assert not stopping_criteria, 'beam search only stops at eos or max_length'
+        assert eos_token_id is not None, 'beam search needs eos_token_id'
+        assert precondition_topk >= 2 * num_beams, 'beam search needs 2 * num_beams candidates per beam'
+        exact_topk = 2 * num_beams # beam search takes the best 2 * num_beams continuations of each example
+    elif do_sample:
+        exact_topk = top_k if top_k > 0 else None # top_p and temperature only look at what's left after top_k
+    else:
+        exact_topk = 1
+
+    with ThreadPoolExecutor(predictor_threads) if predictor_threads > 1 else nullcontext() as executor:
+        # the same order huggingface's generate uses: its own processors, then ours, then the sampling warpers
+        processors, warpers = LogitsProcessorList(), LogitsProcessorList()
+        if bad_words_ids is not None:
+            processors.append(NoBadWordsLogitsProcessor(bad_words_ids, eos_token_id=eos_token_id))
+        if forced_eos_token_id is not None:
+            processors.append(ForcedEOSTokenLogitsProcessor(max_length, forced_eos_token_id))
+        conditioning = FudgeLogitsProcessor(predictors, precondition_topk=precondition_topk, exact_topk=exact_topk, executor=executor)
+        if do_sample:
+            if temperature != 1.0:
+                warpers.append(TemperatureLogitsWarper(temperature))
+            if top_k > 0:
+                warpers.append(TopKLogitsWarper(top_k))
+            if top_p < 1.0:
+                warpers.append(TopPLogitsWarper(top_p))
+        def process_scores(input_ids, scores, rows):
+            return warpers(input_ids, conditioning.process(input_ids, processors(input_ids, scores), rows))
+
+        if num_beams > 1:
+            return beam_search(decoder, process_scores, batch_size, max_length, num_beams, length_penalty, early_stopping, eos_token_id)
+        return sample(decoder, process_scores, batch_size, max_length, do_sample, eos_token_id, stopping_criteria or [])
+
+
+def sample(decoder, process_scores, batch_size, max_length, do_sample, eos_token_id, stopping_criteria):
+    """
+    greedy decoding or sampling for generate, dropping rows from the batch as they finish
+    """
+    outputs = [None for _ in range(batch_size)]
+    rows = torch.arange(batch_size).to(decoder.input_ids.device) # generate batch index of each row still in the batch
+    def is_done(input_ids, rows):
+        done = torch.zeros(len(rows)).bool().to(input_ids.device)
+        for criterion in stopping_criteria:
+            done = done | criterion(input_ids, rows)
+        return done
+    done = is_done(decoder.input_ids, rows)
+    while True:
+        for row in done.nonzero().flatten().tolist():
+            outputs[rows[row]] = decoder.input_ids[row]
+        if done.all() or decoder.input_ids.shape[1] >= max_length:
+            break
+        if done.any():
+            keep = (~done).nonzero().flatten()
+            rows = rows[keep]
+            decoder.select(keep)
+
+        scores = process_scores(decoder.input_ids, decoder.logits(), rows)
+        if do_sample:
+            next_tokens = torch.multinomial(F.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+        else:
+            next_tokens = scores.argmax(dim=-1)
+        decoder.append(torch.arange(len(rows)).to(rows.device), next_tokens)
+        done = is_done(decoder.input_ids, rows)
+        if eos_token_id is not None:
+            done = done | (next_tokens == eos_token_id)
+    for row, generate_row in enumerate(rows.tolist()): # rows cut off at max_length
+        if outputs[generate_row] is None:
+            outputs[generate_row] = decoder.input_ids[row]
+    return outputs
+
+
+def beam_search(decoder, process_scores, batch_size, max_length, num_beams, length_penalty, early_stopping, eos_token_id):
+    """
+    beam search for generate, as huggingface's (BeamSearchScorer): the best num_beams candidates of each example that don't end in eos 
+    are its new beams, and those that do (among its best num_beams) are hypotheses. an example's beams are dropped from the batch 
+    once it's done, i.e. no beam can beat its num_beams best hypotheses.
+    """
+    device = decoder.input_ids.device
+    hypotheses = [BeamHypotheses(num_beams, length_penalty, early_stopping, max_length=max_length) for _ in range(batch_size)]
+    examples = torch.arange(batch_size).to(device) # example of each group of num_beams rows still in the batch
+    beam_rows = torch.arange(batch_size).to(device).repeat_interleave(num_beams) # each example gets num_beams consecutive rows
+    decoder.select(beam_rows)
+    prompt_length = decoder.input_ids.shape[1]
+    beam_scores = torch.zeros(batch_size, num_beams).to(device)
+    beam_scores[:, 1:] = -1e9 # the beams start out identical, so only expand the first one on the first step
+    beam_scores = beam_scores.view(-1) # batch*beams
+    while True:
+        num_examples = len(examples)
+        rows = (examples.unsqueeze(1) * num_beams + torch.arange(num_beams).to(device).unsqueeze(0)).flatten() # generate batch index of each row
+        scores = process_scores(decoder.input_ids, F.log_softmax(decoder.logits(), dim=-1), rows) + beam_scores.unsqueeze(1) # examples*beams x vocab
+        vocab_size = scores.shape[1]
+        next_scores, next_candidates = scores.view(num_examples, num_beams * vocab_size).topk(2 * num_beams, dim=1) # examples x 2*beams
+        next_rows = next_candidates // vocab_size + torch.arange(num_examples).to(device).unsqueeze(1) * num_beams # the beam extended
+        next_tokens = next_candidates % vocab_size
+        cur_len = decoder.input_ids.shape[1] + 1
+
+        # candidates ending in eos become hypotheses if they're among the best num_beams; the best num_beams others are the new beams.
+        # each beam has eos among its candidates at most once, so there are always enough others
+        is_eos = next_tokens == eos_token_id
+        for example, rank in is_eos.nonzero().tolist():
+            if rank < num_beams:
+                tokens = torch.cat([decoder.input_ids[next_rows[example, rank]], next_tokens[example, rank:rank + 1]])
+                hypotheses[examples[example]].add(tokens, next_scores[example, rank].item(), generated_len=cur_len - prompt_length)
+        chosen = (~is_eos) & ((~is_eos).long().cumsum(dim=1) <= num_beams) # examples x 2*beams, num_beams per row
+        beam_scores = next_scores[chosen]
+        decoder.append(next_rows[chosen], next_tokens[chosen])
+        done = torch.BoolTensor([hypotheses[example].is_done(best_score, cur_len, prompt_length) 
+                                 for example, best_score in zip(examples.tolist(), next_scores[:, 0].tolist())]).to(device)
+
+        if done.all():
+            break
+        if decoder.input_ids.shape[1] >= max_length:
+            # out of length: the open beams of examples that aren't done are hypotheses too
+            for row in (~done).repeat_interleave(num_beams).nonzero().flatten().tolist():
+                hypotheses[examples[row // num_beams]].add(decoder.input_ids[row], beam_scores[row].item(), generated_len=decoder.input_ids.shape[1] - prompt_length)
+            break
+        if done.any():
+            keep = (~done).repeat_interleave(num_beams).nonzero().flatten()
+            examples, beam_scores = examples[~done], beam_scores[keep]
+            decoder.select(keep)
+    return [sorted(hyps.beams, key=lambda hyp: hyp[0])[-1][1] for hyps in hypotheses] # ties go to the latest, as in huggingface's
+
+
+def candidate_inputs(input_ids, text_start, candidates):
+    """
+    inputs for rerunning a (non-causal) predictor over the whole text with each candidate appended: each row's text, from text_start,
+    shifted to the front and right-padded with 0s as the predictors want, with the candidate right after it.
+    text_start: batch; candidates: batch x K
+    returns: token ids, batch x K x seq+1; and lengths of the text without the candidate, batch
+    """
+    num_candidates = candidates.shape[1]
+    seq_len = input_ids.shape[1]
+    lengths = seq_len - text_start # batch
+    positions = torch.arange(seq_len + 1).to(input_ids.device).unsqueeze(0) # 1 x seq+1
+    right_padded_input = input_ids.gather(1, (text_start.unsqueeze(1) + positions).clamp(max=seq_len - 1)) * (positions < lengths.unsqueeze(1)).long() # batch x seq+1
+    new_input_candidates = right_padded_input.unsqueeze(1).repeat(1, num_candidates, 1) # batch x K x seq+1
+    new_input_candidates.scatter_(2, lengths.view(-1, 1, 1).expand(-1, num_candidates, 1), candidates.unsqueeze(2))
+    return new_input_candidates, lengths
+
+
+def match_rows(input_ids, cached_ids):
+    """
+    for each row of input_ids, the index of an identical row of cached_ids, and whether there is one
+    """
+    matches = (input_ids.unsqueeze(1) == cached_ids.unsqueeze(0)).all(dim=2) # rows x cached rows
+    return matches.long().argmax(dim=1), matches.any(dim=1)
+
+
+class IncrementalPredictor:
+    """
+    a fudge predictor from a causal conditioning model (model.incremental), which advances its lstm one token per step
+    instead of rerunning it over the whole prefix. generate can reorder and repeat rows between steps (beam search),
+    so the lstm state of each row's text is looked up by its tokens: either an identical row was already seen this step,
+    or the row is one seen last step plus one token. anything else is run from scratch.
+    text_start: where the model's text starts in each row of the generate batch, e.g. past the left padding or the decoder start token; batch
+    step_inputs: function (input_ids, candidates, rows) -> extra args to model.step after the candidates, e.g. syllables_to_go
+    """
+    def __init__(self, model, text_start, step_inputs=None):
+        self.model = model
+        self.text_start = text_start
+        self.step_inputs = step_inputs
+        self.cache = {} # seq length -> (token ids, cached rows x seq; (h, c), each num_layers x cached rows x hidden)
+
+
+    def __call__(self, input_ids, candidates, rows):
+        state = self.text_state(input_ids, rows)
+        extra_inputs = () if self.step_inputs is None else self.step_inputs(input_ids, candidates, rows)
+        condition_logits, _ = self.model.step(state, candidates, *extra_inputs) # rows x K
+        return condition_logits - torch.log(1 + torch.exp(condition_logits)) # get correct log probs
+
+
+    def text_state(self, input_ids, rows):
+        """
+        the model's lstm state over the text so far of each row; (h, c), each num_layers x rows x hidden
+        """
+        seq_len = input_ids.shape[1]
+        for cached_len in list(self.cache):
+            if cached_len < seq_len - 1:
+                del self.cache[cached_len]
+        num_layers, hidden_dim = self.model.rnn.num_layers, self.model.rnn.hidden_size
+        state = tuple(torch.zeros(num_layers, input_ids.shape[0], hidden_dim).to(input_ids.device) for _ in range(2))
+        seen = torch.zeros(input_ids.shape[0]).bool().to(input_ids.device)
+        if seq_len in self.cache: # rows already seen this step
+            cached_ids, cached_state = self.cache[seq_len]
+            index, seen = match_rows(input_ids, cached_ids)
+            for s, cs in zip(state, cached_state):
+                s[:, seen] = cs[:, index[seen]]
+        missing = ~seen
+        text_start = self.text_start[rows]
+        extend = (missing & (text_start < seq_len)).nonzero().flatten() # rows whose text ends in their newest token
+        if seq_len - 1 in self.cache and len(extend) > 0: # rows seen last step, plus that token
+            cached_ids, cached_state = self.cache[seq_len - 1]
+            index, found = match_rows(input_ids[extend, :-1], cached_ids)
+            extend, index = extend[found], index[found]
+            if len(extend) > 0:
+                new_state = self.model.advance(tuple(cs[:, index].contiguous() for cs in cached_state), input_ids[extend, -1])
+                for s, ns in zip(state, new_state):
+                    s[:, extend] = ns
+                missing[extend] = False
+        if missing.any():
+            missing = missing.nonzero().flatten()
+            texts = [ids[start:].tolist() for ids, start in zip(input_ids[missing], text_start[missing].tolist())]
+            new_state = self.model.prefix_state(right_pad_tokens(texts).to(input_ids.device), torch.LongTensor([len(text) for text in texts]).to(input_ids.device))
+            if new_state is not None: # else the texts are all empty, and the zero state is right
+                for s, ns in zip(state, new_state):
+                    s[:, missing] = ns
+        if not seen.all():
+            new_ids, new_state = input_ids[~seen], tuple(s[:, ~seen] for s in state)
+            if seq_len in self.cache:
+                cached_ids, cached_state = self.cache[seq_len]
+                new_ids, new_state = torch.cat([cached_ids, new_ids], dim=0), tuple(torch.cat([cs, ns], dim=1) for cs, ns in zip(cached_state, new_state))
+            self.cache[seq_len] = (new_ids, new_state)
+        return state
@@ -4,6 +4,7 @@ import time
 import pickle
 import math
 from argparse import ArgumentParser
+from contextlib import nullcontext
 
 from tqdm import tqdm
 import numpy as np
@@ -12,98 +13,150 @@ import torch.nn as nn
 
 from data import Dataset
 from model import Model
-from util import save_checkpoint, ProgressMeter, AverageMeter, num_params, pad_mask
+from util import CheckpointWriter, ProgressMeter, AverageMeter, num_params, pad_mask, autocast, grad_scaler, suppress_stdout, rng_states, set_rng_states
+from poetry_util import load_phonetics_table
 from constants import *
 
 
-def train(model, dataset, optimizer, criterion, epoch, args, data_start_index):
+def checkpoint_state(model, optimizer, scaler, dataset, epoch, best_val_metric, data_start_index, args, batch_position=None):
+    """
+    everything needed to pick training back up exactly. batch_position is the number of batches of epoch done so far, or None if
+    the epoch is done; data_start_index is where the epoch's slice of the train split starts in the first case, and the next epoch's in the second.
+    """
+    return {
+        'epoch': epoch,
+        'batch_position': batch_position,
+        'state_dict': model.state_dict(),
+        'best_metric': best_val_metric,
+        'optimizer': optimizer.state_dict(),
+        'scaler': scaler.state_dict(),
+        'data_start_index': data_start_index,
+        'train_shuffle_seed': dataset.shuffle_seeds['train'],
+        'rng_states': rng_states(),
+        'args': args
+    }
+
+
+def train(model, dataset, optimizer, scaler, criterion, epoch, args, data_start_index, start_batch=0, checkpoint_writer=None, best_val_metric=None):
+    """
+    model may be wrapped in DistributedDataParallel, in which case each process trains on its own shard of the examples.
+    start_batch skips the batches of the epoch that were done before resuming. with args.checkpoint_freq, writes model_latest.pth.tar 
+    every that many batches.
+    """
     model.train()
-    if data_start_index == 0:
+    epoch_start_index = data_start_index
+    if data_start_index == 0 and start_batch == 0:
         dataset.shuffle('train', seed=epoch + args.seed)
     if args.epoch_max_len is not None:
         data_end_index = min(data_start_index + args.epoch_max_len, len(dataset.splits['train']))
-        loader = dataset.loader('train', num_workers=args.num_workers, indices=list(range(data_start_index, data_end_index)))
+        loader = dataset.loader('train', num_workers=args.num_workers, indices=list(range(data_start_index, data_end_index)), seed=epoch + args.seed, num_replicas=args.world_size, rank=args.rank, start=start_batch, length_buckets=args.length_buckets, max_tokens=args.max_tokens)
         data_start_index = data_end_index if data_end_index < len(dataset.splits['train']) else 0
     else:
-        loader = dataset.loader('train', num_workers=args.num_workers)
+        loader = dataset.loader('train', num_workers=args.num_workers, seed=epoch + args.seed, num_replicas=args.world_size, rank=args.rank, start=start_batch, length_buckets=args.length_buckets, max_tokens=args.max_tokens)
     loss_meter = AverageMeter('loss', ':6.4f')
-    total_length = len(loader)
-    progress = ProgressMeter(total_length, [loss_meter], prefix='Training: ')
-    for batch_num, batch in enumerate(tqdm(loader, total=len(loader))):
-        batch = [tensor.to(args.device) for tensor in batch]
-        inputs, lengths, future_words, log_probs, labels, classification_targets, syllables_to_go, future_word_num_syllables, rhyme_group_index = batch
-        if args.task not in ['formality', 'iambic']:
-            if not args.debug and len(inputs) != args.batch_size: # it'll screw up the bias...?
-                continue
-        scores = model(inputs, lengths, future_words, log_probs, syllables_to_go, future_word_num_syllables, rhyme_group_index, run_classifier=True)
-        if args.task == 'formality': # we're learning for all positions at once. scores are batch x seq
-            expanded_labels = classification_targets.unsqueeze(1).expand(-1, scores.shape[1]) # batch x seq
-            length_mask = pad_mask(lengths).permute(1, 0) # batch x seq
-            loss = criterion(scores.flatten()[length_mask.flatten()==1], expanded_labels.flatten().float()[length_mask.flatten()==1])
-        elif args.task in ['iambic', 'newline']:
-            use_indices = classification_targets.flatten() != -1
-            loss = criterion(scores.flatten()[use_indices], classification_targets.flatten().float()[use_indices])
-        else: # topic, rhyme
-            loss = criterion(scores.flatten(), labels.flatten().float())
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        loss_meter.update(loss.detach(), len(labels))
-        if batch_num % args.train_print_freq == 0:
-            progress.display(batch_num)
+    padding_meter = AverageMeter('padding', ':6.4f') # fraction of the input tokens that are padding
+    total_length = start_batch + len(loader)
+    progress = ProgressMeter(total_length, [loss_meter, padding_meter], prefix='Training: ')
+    join = model.join() if isinstance(model, nn.parallel.DistributedDataParallel) else nullcontext() # shards can yield different numbers of batches
+    with join:
+        for batch_num, batch in enumerate(tqdm(loader, total=len(loader), disable=args.rank > 0), start=start_batch):
+            padding_meter.update(1 - batch.lengths.sum().item() / batch.inputs.numel(), batch.inputs.numel()) # from the cpu copy, so no device sync
+            inputs, lengths, future_words, log_probs, labels, classification_targets, syllables_to_go, future_word_num_syllables, rhyme_group_index = [tensor.to(args.device) for tensor in batch]
+            with autocast(args.device, args.precision):
+                scores = model(inputs, lengths, future_words, log_probs, syllables_to_go, future_word_num_syllables, rhyme_group_index, run_classifier=True)
+                if args.task == 'formality': # we're learning for all positions at once. scores are batch x seq
+                    expanded_labels = classification_targets.unsqueeze(1).expand(-1, scores.shape[1]) # batch x seq
+                    length_mask = pad_mask(lengths).permute(1, 0) # batch x seq
+                    loss = criterion(scores.flatten()[length_mask.flatten()==1], expanded_labels.flatten().float()[length_mask.flatten()==1])
+                elif args.task in ['iambic', 'newline']:
+                    use_indices = classification_targets.flatten() != -1
+                    loss = criterion(scores.flatten()[use_indices], classification_targets.flatten().float()[use_indices])
+                else: # topic, rhyme
+                    loss = criterion(scores.flatten(), labels.flatten().float())
+            optimizer.zero_grad()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            loss_meter.update(loss.detach(), len(labels))
+            if batch_num % args.train_print_freq == 0:
+                progress.display(batch_num)
+            if args.checkpoint_freq is not None and (batch_num + 1) % args.checkpoint_freq == 0 and not args.debug and args.rank == 0:
+                plain_model = model.module if isinstance(model, nn.parallel.DistributedDataParallel) else model
+                checkpoint_writer.save(checkpoint_state(plain_model, optimizer, scaler, dataset, epoch, best_val_metric, epoch_start_index, args, batch_position=batch_num + 1), latest=True)
     progress.display(total_length)
     return data_start_index
 
 
 def validate(model, dataset, criterion, epoch, args):
+    """
+    with multiple processes, each validates its shard of the examples and we average the loss over all of them. copies that only pad out
+    topic and rhyme batches (labels of -1) are left out.
+    """
     model.eval()
-    random.seed(0)
-    loader = dataset.loader('val', num_workers=args.num_workers)
+    loader = dataset.loader('val', num_workers=args.num_workers, seed=0, num_replicas=args.world_size, rank=args.rank, length_buckets=args.length_buckets, max_tokens=args.max_tokens)
     loss_meter = AverageMeter('loss', ':6.4f')
     total_length = len(loader)
     progress = ProgressMeter(total_length, [loss_meter], prefix='Validation: ')
     with torch.no_grad():
-        for batch_num, batch in enumerate(tqdm(loader, total=len(loader))):
+        for batch_num, batch in enumerate(tqdm(loader, total=len(loader), disable=args.rank > 0)):
+            num_examples = (batch.labels[:, 0] != -1).sum().item() # from the cpu copy, leaving out padding copies
             batch = [tensor.to(args.device) for tensor in batch]
             inputs, lengths, future_words, log_probs, labels, classification_targets, syllables_to_go, future_word_num_syllables, rhyme_group_index = batch
-            if args.task not in ['formality', 'iambic']: # topic predictor
-                if not args.debug and len(inputs) != args.batch_size:
-                    continue
-            scores = model(inputs, lengths, future_words, log_probs, syllables_to_go, future_word_num_syllables, rhyme_group_index, run_classifier=True)
-            if args.task == 'formality': # we're learning for all positions at once. scores are batch x seq
-                expanded_labels = classification_targets.unsqueeze(1).expand(-1, scores.shape[1]) # batch x seq
-                length_mask = pad_mask(lengths).permute(1, 0) # batch x seq
-                loss = criterion(scores.flatten()[length_mask.flatten()==1], expanded_labels.flatten().float()[length_mask.flatten()==1])
-            elif args.task in ['iambic', 'newline']:
-                use_indices = classification_targets.flatten() != -1
-                loss = criterion(scores.flatten()[use_indices], classification_targets.flatten().float()[use_indices])
-            else: # topic, rhyme
-                loss = criterion(scores.flatten(), labels.flatten().float())
-            loss_meter.update(loss.detach(), len(labels))
+            with autocast(args.device, args.precision):
+                scores = model(inputs, lengths, future_words, log_probs, syllables_to_go, future_word_num_syllables, rhyme_group_index, run_classifier=True)
+                if args.task == 'formality': # we're learning for all positions at once. scores are batch x seq
+                    expanded_labels = classification_targets.unsqueeze(1).expand(-1, scores.shape[1]) # batch x seq
+                    length_mask = pad_mask(lengths).permute(1, 0) # batch x seq
+                    loss = criterion(scores.flatten()[length_mask.flatten()==1], expanded_labels.flatten().float()[length_mask.flatten()==1])
+                elif args.task in ['iambic', 'newline']:
+                    use_indices = classification_targets.flatten() != -1
+                    loss = criterion(scores.flatten()[use_indices], classification_targets.flatten().float()[use_indices])
+                else: # topic, rhyme
+                    use_indices = labels.flatten() != -1 # the rows of copies that only pad out the batch
+                    loss = criterion(scores.flatten()[use_indices], labels.flatten().float()[use_indices])
+            if num_examples > 0:
+                loss_meter.update(loss.detach(), num_examples)
             if batch_num % args.train_print_freq == 0:
                 progress.display(batch_num)
+    if args.world_size > 1:
+        totals = torch.Tensor([float(loss_meter.sum), loss_meter.count]).to(args.device)
+        torch.distributed.all_reduce(totals)
+        loss_meter.avg = (totals[0] / totals[1]).item()
     progress.display(total_length)
     return loss_meter.avg
 
 
 def main(args):
+    if args.phonetics_table is not None:
+        load_phonetics_table(args.phonetics_table) # before the dataset, so the loader workers inherit it
     dataset = Dataset(args)
-    os.makedirs(args.save_dir, exist_ok=True)
-    with open(os.path.join(args.save_dir, 'dataset_info'), 'wb') as wf:
-        pickle.dump(dataset.dataset_info, wf)
-    if args.task == 'rhyme':
-        with open(os.path.join(args.save_dir, 'rhyme_info'), 'wb') as wf:
-            pickle.dump(dataset.rhyme_info, wf)
+    if args.rank == 0:
+        os.makedirs(args.save_dir, exist_ok=True)
+        with open(os.path.join(args.save_dir, 'dataset_info'), 'wb') as wf:
+            pickle.dump(dataset.dataset_info, wf)
+        if args.task == 'rhyme':
+            with open(os.path.join(args.save_dir, 'rhyme_info'), 'wb') as wf:
+                pickle.dump(dataset.rhyme_info, wf)
     if args.ckpt:
         checkpoint = torch.load(args.ckpt, map_location=args.device)
-        start_epoch = checkpoint['epoch'] + 1
+        if checkpoint.get('batch_position') is None: # saved at the end of the epoch
+            start_epoch, start_batch = checkpoint['epoch'] + 1, 0
+        else:
+            start_epoch, start_batch = checkpoint['epoch'], checkpoint['batch_position']
+        if checkpoint.get('train_shuffle_seed') is not None:
+            dataset.shuffle('train', seed=checkpoint['train_shuffle_seed'])
         best_val_metric = checkpoint['best_metric']
         model_args = checkpoint['args']
         model = Model(model_args, dataset.gpt_pad_id, len(dataset.index2word), rhyme_group_size=len(dataset.index2rhyme_group) if args.task == 'rhyme' else None) # no need to get the glove embeddings when reloading since they're saved in model ckpt anyway
         model.load_state_dict(checkpoint['state_dict'])
         model = model.to(args.device)
-        optimizer = torch.optim.Adam(model.parameters(), lr=model_args.lr)
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr * args.world_size)
         optimizer.load_state_dict(checkpoint['optimizer'])
+        for param_group in optimizer.param_groups: # the saved state has the lr for the old world size
+            param_group['lr'] = args.lr * args.world_size
+        scaler = grad_scaler(args.device, args.precision)
+        if scaler.is_enabled() and len(checkpoint.get('scaler', {})) > 0: # nothing to load from an fp32/bf16 run
+            scaler.load_state_dict(checkpoint['scaler'])
         data_start_index = checkpoint['data_start_index']
         print("=> loaded checkpoint '{}' (epoch {})"
                 .format(args.ckpt, checkpoint['epoch']))
@@ -113,43 +166,41 @@ def main(args):
     else:
         model = Model(args, dataset.gpt_pad_id, len(dataset.index2word), rhyme_group_size=len(dataset.index2rhyme_group) if args.task == 'rhyme' else None, glove_embeddings=dataset.glove_embeddings)
         model = model.to(args.device)
-        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr * args.world_size) # lr is per process batch; scale linearly with the global batch
+        scaler = grad_scaler(args.device, args.precision)
         best_val_metric = 1e8 # lower is better for BCE
         data_start_index = 0
+        start_epoch, start_batch = 0, 0
     print('num params', num_params(model))
     criterion = nn.BCEWithLogitsLoss().to(args.device)
+    if args.world_size > 1: # all-reduce gradients across processes; model stays the plain module for validation and checkpoints
+        train_model = nn.parallel.DistributedDataParallel(model, device_ids=[torch.cuda.current_device()] if args.device == 'cuda' else None, find_unused_parameters=True)
+    else:
+        train_model = model
     
     if args.evaluate:
         epoch = 0
         validate(model, dataset, criterion, epoch, args)
         return
-    for epoch in range(args.epochs):
+    if args.ckpt and 'rng_states' in checkpoint:
+        set_rng_states(checkpoint['rng_states']) # last, since setting up the data and model draws from them
+    checkpoint_writer = CheckpointWriter(args.save_dir, keep_last=args.keep_checkpoints)
+    for epoch in range(start_epoch, args.epochs):
         print("TRAINING: Epoch {} at {}".format(epoch, time.ctime()))
-        data_start_index = train(model, dataset, optimizer, criterion, epoch, args, data_start_index)
+        data_start_index = train(train_model, dataset, optimizer, scaler, criterion, epoch, args, data_start_index, start_batch=start_batch if epoch == start_epoch else 0, checkpoint_writer=checkpoint_writer, best_val_metric=best_val_metric)
         if epoch % args.validation_freq == 0:
             print("VALIDATION: Epoch {} at {}".format(epoch, time.ctime()))
             metric = validate(model, dataset, criterion, epoch, args)
 
-            if not args.debug:
-                if metric < best_val_metric:
+            if not args.debug and args.rank == 0:
+                is_best = metric < best_val_metric
+                if is_best:
                     print('new best val metric', metric)
                     best_val_metric = metric
-                    save_checkpoint({
-                        'epoch': epoch,
-                        'state_dict': model.state_dict(),
-                        'best_metric': best_val_metric,
-                        'optimizer': optimizer.state_dict(),
-                        'data_start_index': data_start_index,
-                        'args': args
-                    }, os.path.join(args.save_dir, 'model_best.pth.tar'))
-                save_checkpoint({
-                    'epoch': epoch,
-                    'state_dict': model.state_dict(),
-                    'best_metric': metric,
-                    'optimizer': optimizer.state_dict(),
-                    'data_start_index': data_start_index,
-                    'args': args
-                }, os.path.join(args.save_dir, 'model_epoch' + str(epoch) + '.pth.tar'))
+                checkpoint_writer.save(checkpoint_state(model, optimizer, scaler, dataset, epoch, best_val_metric, data_start_index, args), 'model_epoch' + str(epoch) + '.pth.tar', best=is_best, latest=args.checkpoint_freq is not None)
+        elif args.checkpoint_freq is not None and not args.debug and args.rank == 0:
+            checkpoint_writer.save(checkpoint_state(model, optimizer, scaler, dataset, epoch, best_val_metric, data_start_index, args), latest=True)
+    checkpoint_writer.close()
 
 
 if __name__=='__main__':
@@ -157,24 +208,33 @@ if __name__=='__main__':
 
     # DATA
     parser.add_argument('--task', type=str, required=True, choices=['iambic', 'rhyme', 'newline', 'topic', 'formality'])
-    parser.add_argument('--data_dir', type=str, required=True)
+    parser.add_argument('--data_dir', type=str, default=None, help='raw data; tokenized on the fly every epoch')
+    parser.add_argument('--corpus', type=str, default=None, help='pre-tokenized corpus from corpus.py, used instead of --data_dir')
     parser.add_argument('--glove_file', type=str, help='glove embedding init, for topic task')
+    parser.add_argument('--glove_cache', type=str, default=None, help='dir to cache the vocab\'s glove vectors in, so later runs skip parsing --glove_file')
 
     # SAVE/LOAD
     parser.add_argument('--save_dir', type=str, required=True, help='where to save ckpts')
     parser.add_argument('--ckpt', type=str, default=None, help='load ckpt from file if given')
+    parser.add_argument('--checkpoint_freq', type=int, default=None, help='also save model_latest.pth.tar every X batches (and after every epoch), to resume from with --ckpt if the run is killed')
+    parser.add_argument('--keep_checkpoints', type=int, default=None, help='only keep this many of the latest model_epoch ckpts (plus model_best); default keeps all')
     parser.add_argument('--dataset_info', type=str, help='saved dataset info')
     parser.add_argument('--rhyme_info', type=str, help='saved dataset rhyme info, for a ckpt with task==rhyme')
+    parser.add_argument('--phonetics_table', type=str, default=None, help='precompiled phonetics from poetry_util.py, to speed up syllable/stress/rhyme lookups')
 
     # TRAINING
     parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--length_buckets', action='store_true', default=False, help='batch sentences of similar length together to cut padding (formality and topic)')
+    parser.add_argument('--max_tokens', type=int, default=None, help='cap batches at this many padded tokens (up to batch_size examples); implies --length_buckets. formality only')
     parser.add_argument('--epochs', type=int, default=100)
     parser.add_argument('--epoch_max_len', type=int, default=None, help='max batches per epoch if set, for more frequent validation')
     parser.add_argument('--validation_freq', type=int, default=1, help='validate every X epochs')
     parser.add_argument('--lr', type=float, default=1e-3, help='Adam learning rate')
     parser.add_argument('--seed', type=int, default=1, help='random seed')
     parser.add_argument('--device', type=str, default='cuda', choices=['cpu', 'cuda'])
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='autocast precision for training and validation; fp16 uses loss scaling')
     parser.add_argument('--num_workers', type=int, default=20, help='num workers for data loader')
+    parser.add_argument('--dist_backend', type=str, default='gloo', help='torch.distributed backend when launched with torchrun on multiple processes')
     parser.add_argument('--evaluate', action='store_true', default=False)
     parser.add_argument('--debug', action='store_true', default=False)
 
@@ -186,7 +246,16 @@ if __name__=='__main__':
     random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
+    assert (args.data_dir is None) != (args.corpus is None), 'give exactly one of --data_dir and --corpus'
+    assert args.task in ['formality', 'topic'] or not args.length_buckets, '--length_buckets is only for formality and topic'
+    assert args.task == 'formality' or args.max_tokens is None, '--max_tokens is only for formality; topic and rhyme need batch_size examples in every batch'
+    args.world_size, args.rank = int(os.environ.get('WORLD_SIZE', 1)), int(os.environ.get('RANK', 0)) # set by torchrun
+    if args.world_size > 1:
+        torch.distributed.init_process_group(backend=args.dist_backend)
+        if args.device == 'cuda':
+            torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
     if args.evaluate:
         assert args.ckpt is not None
     
-    main(args)
\ No newline at end of file
+    with suppress_stdout() if args.rank > 0 else nullcontext(): # only the first process prints
+        main(args)
\ No newline at end of file
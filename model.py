@@ -77,7 +77,7 @@ class Model(nn.Module):
         inputs: token ids, batch x seq, right-padded with 0s
         lengths: lengths of inputs; batch
         future_words: batch x N words to check if not predict next token, else batch
-        log_probs: N
+        log_probs: N, or batch x N when each row has its own future words
         syllables_to_go: batch
         """
         if self.topic:
@@ -90,16 +90,12 @@ class Model(nn.Module):
             attention_mask = pad_mask(lengths).permute(1, 0) # batch x seq
             embed = self.word_embed(future_words) # batch x N x 300
             embed_query = self.embed_key_linear(embed)
-            attention_tensor = self.attention_linear(hidden).unsqueeze(2) * embed_query.unsqueeze(1) # batch x seq x N x 300
-            attention_weights = F.softmax(attention_tensor.sum(dim=3), dim=1) # batch x seq x N
-            attention_weights = attention_weights * attention_mask.unsqueeze(2)
-            hidden = self.attention_value_linear(hidden)
-            weighted_hidden = (hidden.unsqueeze(2) * attention_weights.unsqueeze(3)).sum(dim=1) # batch x seq x N x 768 -> batch x N x 768
+            weighted_hidden = self.attend(hidden, embed_query, attention_mask) # batch x N x 300
             unnormalized_scores = (self.out_linear(weighted_hidden) * self.out_embed_linear(embed)) # batch x N x 300
             unnormalized_scores = torch.cat([unnormalized_scores, embed], dim=2)
             unnormalized_scores = self.nonlinear(self.out_linear2(self.nonlinear(unnormalized_scores)))
             unnormalized_scores = self.out_linear3(unnormalized_scores)
-            scores = unnormalized_scores.squeeze(2) - log_probs.unsqueeze(0) 
+            scores = unnormalized_scores.squeeze(2) - (log_probs if log_probs.dim() == 2 else log_probs.unsqueeze(0))
             return scores # batch x N of normalized scores or batch x 
         elif self.formality:
             inputs = self.marian_embed(inputs)
@@ -127,16 +123,12 @@ class Model(nn.Module):
             embedded_syllables_to_go = self.count_syllable_embed(syllables_to_go).unsqueeze(1).expand(-1, embed.shape[1], -1) # batch x N x 100
             auxiliary_embed = embedded_syllables_to_go
             embed_query = self.embed_key_linear(torch.cat([embed, auxiliary_embed], dim=2))
-            attention_tensor = self.attention_linear(hidden).unsqueeze(2) * embed_query.unsqueeze(1) # batch x seq x N x 300
-            attention_weights = F.softmax(attention_tensor.sum(dim=3), dim=1) # batch x seq x N
-            attention_weights = attention_weights * attention_mask.unsqueeze(2)
-            hidden = self.attention_value_linear(hidden)
-            weighted_hidden = (hidden.unsqueeze(2) * attention_weights.unsqueeze(3)).sum(dim=1) # batch x seq x N x 768 -> batch x N x 768
+            weighted_hidden = self.attend(hidden, embed_query, attention_mask) # batch x N x 300
             unnormalized_scores = (self.out_linear(weighted_hidden) * self.out_embed_linear(embed)) # batch x N x 300
             unnormalized_scores = torch.cat([unnormalized_scores, embed, auxiliary_embed], dim=2)
             unnormalized_scores = self.nonlinear(self.out_linear2(self.nonlinear(unnormalized_scores)))
             unnormalized_scores = self.out_linear3(unnormalized_scores)
-            scores = unnormalized_scores.squeeze(2) - log_probs.unsqueeze(0) 
+            scores = unnormalized_scores.squeeze(2) - (log_probs if log_probs.dim() == 2 else log_probs.unsqueeze(0))
             return scores # batch x N of normalized scores or batch x 
         elif self.newline:
             inputs = self.gpt_embed(inputs) # batch x seq x 300
@@ -148,4 +140,126 @@ class Model(nn.Module):
             return self.out_linear3(self.nonlinear(self.out_linear2(self.nonlinear(self.out_linear(hidden))))).squeeze(2)
         else: 
             raise NotImplementedError
-            
+
+
+    def attend(self, hidden, embed_query, attention_mask):
+        """
+        attention over the lstm outputs for each of the N future words, for topic and rhyme.
+        computed as batched matmuls so we never build the batch x seq x N x 300 intermediate.
+        hidden: batch x seq x 300
+        embed_query: batch x N x 300
+        attention_mask: batch x seq
+        returns: batch x N x 300
+        """
+        attention_logits = torch.bmm(self.attention_linear(hidden), embed_query.transpose(1, 2)) # batch x seq x N
+        attention_weights = F.softmax(attention_logits, dim=1) # batch x seq x N
+        attention_weights = attention_weights * attention_mask.unsqueeze(2)
+        hidden = self.attention_value_linear(hidden)
+        return torch.bmm(attention_weights.transpose(1, 2), hidden) # batch x N x seq @ batch x seq x 300 -> batch x N x 300
+
+
+    @property
+    def incremental(self):
+        """
+        whether the predictor is causal, so prefix_state/step can be used instead of rerunning forward over the whole prefix.
+        topic and rhyme use a bidirectional lstm, whose backward direction depends on the whole sequence including the candidate token,
+        so there's no exact way to cache it; those keep using the full recompute in forward.
+        """
+        return self.formality or self.iambic or self.newline
+
+
+    def embed_tokens(self, inputs):
+        return self.marian_embed(inputs) if self.formality else self.gpt_embed(inputs)
+
+
+    def prefix_state(self, inputs, lengths):
+        """
+        run the lstm over the committed prefix and return its final (h, c) state, to be passed to step.
+        inputs: token ids, batch x seq, right-padded with 0s; seq may be 0 for an empty prefix
+        lengths: lengths of inputs; batch. rows of length 0 get the zero initial state
+        returns: (h, c), each num_layers x batch x rnn hidden, or None if the whole prefix is empty
+        """
+        assert self.incremental
+        if inputs.shape[1] == 0 or lengths.max() == 0:
+            return None
+        inputs = self.embed_tokens(inputs)
+        inputs = pack_padded_sequence(inputs.permute(1, 0, 2), lengths.clamp(min=1).cpu(), enforce_sorted=False)
+        _, (h, c) = self.rnn(inputs)
+        nonempty = (lengths > 0).to(h.dtype).view(1, -1, 1)
+        return h * nonempty, c * nonempty
+
+
+    def step(self, state, candidates, syllables_to_go=None):
+        """
+        score K candidate next tokens for each row by advancing the lstm one token from the prefix state, 
+        instead of rerunning it over prefix + candidate. matches forward(...)[:, -1] on the full sequences.
+        state: (h, c) from prefix_state or select_state, batch-sized; None for an empty prefix
+        candidates: token ids, batch x K
+        syllables_to_go: batch x K, for newline
+        returns: scores, batch x K; and the new state for every candidate, num_layers x batch*K x rnn hidden, for select_state
+        """
+        assert self.incremental
+        batch_size, num_candidates = candidates.shape
+        if state is not None:
+            state = tuple(s.unsqueeze(2).expand(-1, -1, num_candidates, -1).flatten(1, 2).contiguous() for s in state) # num_layers x batch*K x hidden
+        inputs = self.embed_tokens(candidates.flatten()).unsqueeze(0) # 1 x batch*K x 300
+        rnn_output, new_state = self.rnn(inputs, state)
+        rnn_output = rnn_output.squeeze(0) # batch*K x 300
+        if self.newline:
+            hidden = torch.cat([rnn_output, self.count_syllable_embed(syllables_to_go.flatten())], dim=1)
+            scores = self.out_linear3(self.nonlinear(self.out_linear2(self.nonlinear(self.out_linear(hidden)))))
+        else:
+            scores = self.out_linear(rnn_output)
+        return scores.view(batch_size, num_candidates), new_state
+
+
+    def advance(self, state, tokens):
+        """
+        commit one given token per row without scoring anything: the lstm state after it.
+        state: (h, c), batch-sized; None for an empty prefix
+        tokens: token ids, batch
+        """
+        assert self.incremental
+        _, new_state = self.rnn(self.embed_tokens(tokens).unsqueeze(0), state)
+        return new_state
+
+
+    def select_state(self, candidate_state, candidate_indices):
+        """
+        commit one candidate per row: pick its state out of the batch*K states returned by step.
+        candidate_indices: index into the K candidates for each row; batch
+        """
+        batch_size = candidate_indices.shape[0]
+        rows = torch.arange(batch_size).to(candidate_indices.device)
+        return tuple(s.view(s.shape[0], batch_size, -1, s.shape[2])[:, rows, candidate_indices].contiguous() for s in candidate_state)
+
+
+if __name__=='__main__':
+    # parity check of the incremental lstm scoring against the full recompute in forward
+    from argparse import Namespace
+    torch.manual_seed(0)
+    vocab_size, batch_size, num_candidates = 100, 3, 7
+    for task in ['formality', 'iambic', 'newline']:
+        model = Model(Namespace(task=task), vocab_size, 10, verbose=False)
+        model.eval()
+        with torch.no_grad():
+            lengths = torch.LongTensor([5, 0, 3])
+            prefix = torch.randint(1, vocab_size, (batch_size, lengths.max()))
+            prefix = prefix * pad_mask(lengths).permute(1, 0).long()
+            candidates = torch.randint(1, vocab_size, (batch_size, num_candidates))
+            syllables_to_go = torch.randint(0, MAX_COUNT_SYLLABLE_DIST + 1, (batch_size, num_candidates))
+            state = model.prefix_state(prefix, lengths)
+            incremental_scores, candidate_state = model.step(state, candidates, syllables_to_go)
+
+            full_inputs = torch.cat([prefix, torch.zeros(batch_size, 1).long()], dim=1).unsqueeze(1).repeat(1, num_candidates, 1) # batch x K x seq+1
+            full_inputs[torch.arange(batch_size), :, lengths] = candidates
+            full_scores = model(full_inputs.flatten(0, 1), (lengths + 1).unsqueeze(1).expand(-1, num_candidates).flatten(), None, None, syllables_to_go.flatten())
+            full_scores = full_scores[torch.arange(batch_size * num_candidates), lengths.repeat_interleave(num_candidates)].view(batch_size, num_candidates)
+            assert torch.allclose(incremental_scores, full_scores, atol=1e-5), task
+
+            # committing a candidate and stepping again should match the full recompute too
+            chosen = torch.randint(0, num_candidates, (batch_size,))
+            state = model.select_state(candidate_state, chosen)
+            _, (h, c) = model.rnn(model.embed_tokens(full_inputs[torch.arange(batch_size), chosen]).permute(1, 0, 2)[:lengths.max() + 1])
+            assert torch.allclose(state[0][:, 0], h[:, 0], atol=1e-5), task
+        print(task, 'incremental scores match full recompute')
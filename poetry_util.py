@@ -1,11 +1,102 @@
 import string
+import pickle
+from functools import lru_cache
 
 import pronouncing
-from Phyme import Phyme
+from Phyme import Phyme, rhymeUtils
 phyme = Phyme()
 
 from constants import *
 
+# optional precompiled phonetics, so lookups for known words skip the cmu dict and phyme entirely. see load_phonetics_table
+phonetics_table = {'stresses': {}, 'rhymes': {}, 'rhyme_tails': {}}
+phonetics_table_hits = {'stresses': 0, 'rhymes': 0, 'rhyme_tails': 0}
+
+
+@lru_cache(maxsize=PHONETICS_CACHE_SIZE)
+def word_stresses(word):
+    """
+    stress pattern of the first cmu dict pronunciation of word (e.g. '01'), or None if the word isn't in the dict.
+    """
+    word = word.lower() # the cmu dict lookup is case insensitive anyway
+    if word in phonetics_table['stresses']:
+        phonetics_table_hits['stresses'] += 1
+        return phonetics_table['stresses'][word]
+    phones_list = pronouncing.phones_for_word(word)
+    return pronouncing.stresses(phones_list[0]) if len(phones_list) > 0 else None # just default to the first pronunciation if > 1 given
+
+
+@lru_cache(maxsize=PHONETICS_CACHE_SIZE)
+def word_rhymes(word):
+    """
+    sorted tuple of the perfect rhymes of word according to phyme, or None if the word isn't in the rhyme dict.
+    """
+    if word in phonetics_table['rhymes']:
+        phonetics_table_hits['rhymes'] += 1
+        return phonetics_table['rhymes'][word]
+    try:
+        rhyme_dict = phyme.get_perfect_rhymes(word)
+    except KeyError:
+        return None
+    rhymes = set()
+    for length_dict in rhyme_dict.values():
+        for rhyme in length_dict:
+            rhymes.add(rhyme.split('(')[0]) # sometimes you have stuff like preferred(1) where they indicate a particular pronunciation
+    return tuple(sorted(rhymes))
+
+
+@lru_cache(maxsize=PHONETICS_CACHE_SIZE)
+def word_rhyme_tail(word):
+    """
+    the phones that a perfect rhyme of word has to end with, e.g. 'EY1' for day or 'AO1 R IY0' for story, or None if the word isn't in the rhyme dict.
+    this is the last stressed syllable onward minus its leading consonants, which is exactly what phyme searches on for perfect rhymes,
+    so two words have the same rhymes when their tails are equal. much cheaper than listing the rhymes.
+    """
+    if word in phonetics_table['rhyme_tails']:
+        phonetics_table_hits['rhyme_tails'] += 1
+        return phonetics_table['rhyme_tails'][word]
+    try:
+        syllables = rhymeUtils.get_last_syllables(word)
+    except KeyError:
+        return None
+    if syllables[0] is None: # no vowel at all
+        return None
+    return ' '.join(phone for syllable in syllables for phone in syllable)
+
+
+def phonetics_cache_info():
+    """
+    hit/miss counters of the phonetics lookups. misses are then served from the precompiled table if loaded (table_hits), else the dicts.
+    """
+    return {'stresses': word_stresses.cache_info(), 
+            'rhymes': word_rhymes.cache_info(), 
+            'rhyme_tails': word_rhyme_tail.cache_info(), 
+            'table_hits': dict(phonetics_table_hits)}
+
+
+def save_phonetics_table(words, path):
+    """
+    precompile stresses, rhymes, and rhyme tails for the given words to disk, for load_phonetics_table.
+    """
+    table = {'stresses': {}, 'rhymes': {}, 'rhyme_tails': {}}
+    for word in words:
+        table['stresses'][word.lower()] = word_stresses(word)
+        table['rhymes'][word] = word_rhymes(word)
+        table['rhyme_tails'][word] = word_rhyme_tail(word)
+    with open(path, 'wb') as wf:
+        pickle.dump(table, wf)
+
+
+def load_phonetics_table(path):
+    with open(path, 'rb') as rf:
+        table = pickle.load(rf)
+    for key in phonetics_table:
+        phonetics_table[key].update(table.get(key, {}))
+    word_stresses.cache_clear()
+    word_rhymes.cache_clear()
+    word_rhyme_tail.cache_clear()
+
+
 def is_iambic(phrase):
     """
     check that we satisfy iambic meter.
@@ -16,15 +107,13 @@ def is_iambic(phrase):
     meter = ''
     for word in phrase.split():
         word = word.strip().strip(string.punctuation).lower()
-        try:
-            phones_list = pronouncing.phones_for_word(word)
-            stresses = pronouncing.stresses(phones_list[0])
-            if len(stresses) == 1:
-                if stresses == '1':
-                    stresses = '2' # allow ambiguity for 1-syllable words with stress 1
-            meter += stresses # just default to the first pronunciation if > 1 given
-        except:
+        stresses = word_stresses(word)
+        if stresses is None:
             return 0 # word not found
+        if len(stresses) == 1:
+            if stresses == '1':
+                stresses = '2' # allow ambiguity for 1-syllable words with stress 1
+        meter += stresses
     meter = [int(x) for x in meter]
     even_stresses_full = [meter[i] for i in range(0, len(meter), 2)]
     odd_stresses_full = [meter[i] for i in range(1, len(meter), 2)]
@@ -41,27 +130,42 @@ def count_syllables(words):
     syllables = 0
     for word in words.split():
         word = word.strip().strip(string.punctuation)
-        try:
-            phones_list = pronouncing.phones_for_word(word)
-            stresses = pronouncing.stresses(phones_list[0])
+        stresses = word_stresses(word)
+        if stresses is not None:
             syllables += min(MAX_SYLLABLES_PER_WORD, len(stresses))
-        except:
+        else:
             # if we don't know, just do a quick approximation here; it shouldn't come up too often
             syllables += min(MAX_SYLLABLES_PER_WORD, round(len(word) / 3))
     return syllables
 
 
+@lru_cache(maxsize=None)
+def token_word_boundaries(tokenizer):
+    """
+    for each token id, how decoding it after some text affects the words of that text:
+    TOKEN_STARTS_WORD (e.g. ' the', ' (' or ' "'), TOKEN_IS_WHITESPACE, or TOKEN_CONTINUES_WORD (e.g. 'ing', or ' ,', '.' and "'s", which the tokenizer's 
+    space cleanup attaches to the word before).
+    computed once per tokenizer. returns a tuple of ints indexed by token id.
+    """
+    anchor = tokenizer.encode('a')
+    num_anchor_words = len(tokenizer.decode(anchor).split())
+    boundaries = []
+    for i in range(len(tokenizer)):
+        if len(tokenizer.decode([i]).strip()) == 0:
+            boundaries.append(TOKEN_IS_WHITESPACE)
+        elif len(tokenizer.decode(anchor + [i]).split()) > num_anchor_words:
+            boundaries.append(TOKEN_STARTS_WORD)
+        else:
+            boundaries.append(TOKEN_CONTINUES_WORD)
+    return tuple(boundaries)
+
+
 def get_rhymes(word):
     # throws exception if word not in the rhyme dict (rare)
-    rhymes = []
-    rhyme_dict = phyme.get_perfect_rhymes(word)
-    for length_dict in rhyme_dict.values():
-        for word in length_dict:
-            if '(' in word: # sometimes you have stuff like preferred(1) where they indicate a particular pronunciation
-                rhymes.append(word.split('(')[0])
-            else:
-                rhymes.append(word)
-    return sorted(list(set(rhymes)))
+    rhymes = word_rhymes(word)
+    if rhymes is None:
+        raise KeyError(word)
+    return list(rhymes)
 
 
 def get_rhyme_group(word):
@@ -72,12 +176,25 @@ def get_rhyme_group(word):
 def perfect_rhyme_end(s1, s2):
     ending_word1 = s1.split()[-1].strip(string.punctuation)
     ending_word2 = s2.split()[-1].strip(string.punctuation)
-    try:
-        return get_rhyme_group(ending_word1) == get_rhyme_group(ending_word2)
-    except:
+    rhymes1, rhymes2 = word_rhymes(ending_word1), word_rhymes(ending_word2)
+    if rhymes1 is None or rhymes2 is None:
         return False # unknown words
+    return rhymes1 == rhymes2
 
 if __name__=='__main__':
-    result = is_iambic('Shall I compare thee to a summer day')
-    result2 = count_syllables('Shall I compare thee to a summer day')
-    import pdb; pdb.set_trace()
\ No newline at end of file
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--dataset_info', type=str, default=None, help='precompile phonetics for the vocab of this saved dataset info')
+    parser.add_argument('--words_file', type=str, default=None, help='or for these words, one per line')
+    parser.add_argument('--save_path', type=str, required=True, help='where to write the phonetics table, for --phonetics_table')
+    args = parser.parse_args()
+    assert (args.dataset_info is not None) != (args.words_file is not None)
+
+    if args.dataset_info is not None:
+        with open(args.dataset_info, 'rb') as rf:
+            words = pickle.load(rf).index2word
+    else:
+        with open(args.words_file, 'r') as rf:
+            words = [line.strip() for line in rf]
+    save_phonetics_table(words, args.save_path)
+    print('saved phonetics for', len(words), 'words;', phonetics_cache_info())
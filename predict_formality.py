@@ -14,7 +14,9 @@ from transformers import AutoTokenizer, AutoModelWithLMHead, pipeline, set_seed,
 
 from data import Dataset
 from model import Model
-from util import save_checkpoint, ProgressMeter, AverageMeter, num_params
+from util import save_checkpoint, ProgressMeter, AverageMeter, num_params, right_pad_tokens
+import fudge
+from fudge import IncrementalPredictor
 from constants import *
 
 def main(args):
@@ -46,186 +48,62 @@ def main(args):
                         do_sample=args.do_sample,
                         length_cutoff=args.length_cutoff,
                         condition_lambda=args.condition_lambda,
-                        device=args.device)
+                        device=args.device,
+                        topk=args.topk,
+                        top_p=args.top_p,
+                        num_beams=args.num_beams)
         print(results)
         import pdb; pdb.set_trace()
 
 
-def predict_formality(model, tokenizer, conditioning_model, input_text, dataset_info, precondition_topk=200, do_sample=False, length_cutoff=512, condition_lambda=1.0, device='cuda'):
+def encode_sources(tokenizer, input_text, pad_token_id, device):
+    """
+    token ids of the source sentences, batch x seq, right-padded with pad_token_id; and their attention mask, batch x seq
+    """
+    encoded_input = [tokenizer.encode(it) for it in input_text]
+    lengths = torch.LongTensor([len(ei) for ei in encoded_input]).to(device) # batch
+    encoded_input = right_pad_tokens(encoded_input, value=pad_token_id).to(device) # batch x seq
+    attention_mask = (torch.arange(encoded_input.shape[1]).to(device).unsqueeze(0) < lengths.unsqueeze(1)).long() # batch x seq
+    return encoded_input, attention_mask
+
+
+def predict_formality(model, tokenizer, conditioning_model, input_text, dataset_info, precondition_topk=200, do_sample=False, length_cutoff=512, condition_lambda=1.0, device='cuda', topk=0, top_p=1.0, num_beams=1, length_penalty=1.0, early_stopping=False):
+    """
+    input_text: list of source sentences. they can encode to different lengths; the encoder sees them right-padded with an attention mask,
+        and each one is dropped from the batch as soon as its translation finishes.
+    do_sample: sample from the fudge-reweighted distribution over the precondition_topk candidates, restricted to its topk / top_p
+        if those are set, instead of taking the argmax.
+    num_beams: beam search over the fudge-reweighted scores if > 1, i.e. the model's log prob plus condition_lambda times the 
+        conditioning model's log prob of formality for each token; can't be combined with do_sample.
+    the decoding itself is fudge.generate, with the formality predictor as its only predictor.
+    """
     with torch.no_grad():
         batch_size = len(input_text)
-
-        # assumes initially all same length.
-        encoded_input = [tokenizer.encode(it, return_tensors='pt').to(device) for it in input_text] # batch x seq
-        encoded_input = torch.cat(encoded_input, dim=0)
-
-        input_ids = torch.LongTensor([[58100]]).to(device)
-        cur_len = 1
-        max_length = length_cutoff
-        min_length = 0
-        temperature = 1.0
-        top_k = 50
-        top_p = 1.0
-        repetition_penalty = 1.0
-        no_repeat_ngram_size = 0
-        bad_words_ids = [[58100]]
         pad_token_id = 58100
         eos_token_id = 0
-        effective_batch_size = batch_size
-        attention_mask = encoded_input.new_ones(encoded_input.shape)
-        use_cache = True
-        model_specific_kwargs = {'encoder_outputs': model.get_encoder()(encoded_input, attention_mask=attention_mask)}
-
-        output = _generate_no_beam_search(model,
-                                        conditioning_model,
-                                        condition_lambda,
-                                        precondition_topk,
-                                        input_ids,
-                                        cur_len,
-                                        max_length,
-                                        min_length,
-                                        do_sample,
-                                        temperature,
-                                        top_k,
-                                        top_p,
-                                        repetition_penalty,
-                                        no_repeat_ngram_size,
-                                        bad_words_ids,
-                                        pad_token_id,
-                                        eos_token_id,
-                                        batch_size,
-                                        attention_mask,
-                                        use_cache,
-                                        model_specific_kwargs)
-
-        return [tokenizer.decode(s[1:]) for s in output] # 1: to delete the pad token
-
-
-# hack of code from transformers/generation_utils.py
-# to get our conditioning
-def _generate_no_beam_search(
-        model,
-        conditioning_model,
-        condition_lambda,
-        precondition_topk,
-        input_ids,
-        cur_len,
-        max_length,
-        min_length,
-        do_sample,
-        temperature,
-        top_k,
-        top_p,
-        repetition_penalty,
-        no_repeat_ngram_size,
-        bad_words_ids,
-        pad_token_id,
-        eos_token_id,
-        batch_size,
-        attention_mask,
-        use_cache,
-        model_kwargs,
-    ):
-        """Generate sequences for each example without beam search (num_beams == 1).
-        All returned sequence are generated independantly.
-        """
-        # length of generated sentences / unfinished sentences
-        unfinished_sents = input_ids.new(batch_size).fill_(1)
-        sent_lengths = input_ids.new(batch_size).fill_(max_length)
-
-        past = None
-        while cur_len < max_length:
-            model_inputs = model.prepare_inputs_for_generation(
-                input_ids, past=past, attention_mask=attention_mask, use_cache=use_cache, **model_kwargs
-            )
-
-            outputs = model(**model_inputs, return_dict=True)
-            next_token_logits = outputs.logits[:, -1, :]
-
-            scores = model.postprocess_next_token_scores(
-                scores=next_token_logits,
-                input_ids=input_ids,
-                no_repeat_ngram_size=no_repeat_ngram_size,
-                bad_words_ids=bad_words_ids,
-                cur_len=cur_len,
-                min_length=min_length,
-                max_length=max_length,
-                eos_token_id=eos_token_id,
-                repetition_penalty=repetition_penalty,
-                batch_size=batch_size,
-                num_beams=1,
-            )
-
-            # if model has past, then set the past variable to speed up decoding
-            if "past_key_values" in outputs:
-                past = outputs.past_key_values
-            elif "mems" in outputs:
-                past = outputs.mems
-
-            top_logits, top_indices = scores.topk(precondition_topk, dim=1) # batch x topk
-            tplus1_candidates = torch.cat([input_ids.unsqueeze(1).expand(-1, precondition_topk, -1), top_indices.unsqueeze(2)], dim=2)[:, :, 1:] # batch x topk x seq+1, with pad dropped
-            expanded_lengths = torch.LongTensor([[cur_len for _ in range(precondition_topk)] for _ in range(batch_size)]).to(scores.device)
-            if condition_lambda == 0:
-                condition_logits = torch.zeros_like(top_logits).float()
-            else:
-                condition_logits = conditioning_model(tplus1_candidates.flatten(0, 1), # batch*topk x seq+1
-                                                    expanded_lengths.flatten(0, 1), # batch*topk
-                                                    None,
-                                                    None,
-                                                    None)
-                condition_logits = condition_logits.view(batch_size, precondition_topk, -1)[:, :, -1] # batch x topk of last formality pred
-                condition_logits = condition_logits - torch.log(1 + torch.exp(condition_logits)) # get correct log probs
-                # condition_logits = - torch.log(1 + torch.exp(condition_logits)) # for informal
-            full_logits = top_logits + condition_lambda * condition_logits
-            if do_sample:
-                raise NotImplementedError
-            else:
-                # Greedy decoding
-                next_token = top_indices[torch.arange(batch_size).to(top_indices.device), torch.argmax(full_logits, dim=-1)]
-
-            # if do_sample:
-            #     # Temperature (higher temperature => more likely to sample low probability tokens)
-            #     if temperature != 1.0:
-            #         scores = scores / temperature
-            #     # Top-p/top-k filtering
-            #     next_token_logscores = top_k_top_p_filtering(scores, top_k=top_k, top_p=top_p)
-            #     # Sample
-            #     probs = F.softmax(next_token_logscores, dim=-1)
-            #     next_token = torch.multinomial(probs, num_samples=1).squeeze(1)
-            # else:
-            #     # Greedy decoding
-            #     next_token = torch.argmax(next_token_logits, dim=-1)
-
-            # update generations and finished sentences
-            if eos_token_id is not None:
-                # pad finished sentences if eos_token_id exist
-                tokens_to_add = next_token * unfinished_sents + (pad_token_id) * (1 - unfinished_sents)
-            else:
-                tokens_to_add = next_token
-            
-            # add token and increase length by one
-            input_ids = torch.cat([input_ids, tokens_to_add.unsqueeze(-1)], dim=-1)
-            cur_len = cur_len + 1
-
-            if eos_token_id is not None:
-                eos_in_sents = tokens_to_add == eos_token_id
-                # if sentence is unfinished and the token to add is eos, sent_lengths is filled with current length
-                is_sents_unfinished_and_token_to_add_is_eos = unfinished_sents.mul(eos_in_sents.long()).bool()
-                sent_lengths.masked_fill_(is_sents_unfinished_and_token_to_add_is_eos, cur_len)
-                # unfinished_sents is set to zero if eos in sentence
-                unfinished_sents.mul_((~eos_in_sents).long())
-
-            # stop when there is a </s> in each sentence, or if we exceed the maximul length
-            if unfinished_sents.max() == 0:
-                break
-
-            # extend attention_mask for new generated input if only decoder
-            if model.config.is_encoder_decoder is False:
-                attention_mask = torch.cat(
-                    [attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=-1
-                )
-
-        return input_ids
+
+        encoded_input, attention_mask = encode_sources(tokenizer, input_text, pad_token_id, device)
+
+        text_start = torch.ones(batch_size * num_beams).long().to(device) # the conditioning model's text starts after the decoder's start token
+        sampling_args = {'top_k': topk, 'top_p': top_p, 'temperature': 1.0} if do_sample else {}
+        output = fudge.generate(model,
+                                encoded_input,
+                                [(IncrementalPredictor(conditioning_model, text_start), condition_lambda)],
+                                precondition_topk=precondition_topk,
+                                attention_mask=attention_mask,
+                                max_length=length_cutoff,
+                                do_sample=do_sample,
+                                num_beams=num_beams,
+                                length_penalty=length_penalty,
+                                early_stopping=early_stopping,
+                                bad_words_ids=[[pad_token_id]],
+                                eos_token_id=eos_token_id,
+                                forced_eos_token_id=eos_token_id, # as marian's generation config does
+                                decoder_start_token_id=pad_token_id,
+                                **sampling_args)
+
+        return [tokenizer.decode(s[1:]) for s in output] # 1: to delete the pad token; each ends at its eos
+
 
 if __name__=='__main__':
     parser = ArgumentParser()
@@ -239,6 +117,9 @@ if __name__=='__main__':
 
     parser.add_argument('--precondition_topk', type=int, default=200, help='consider top k outputs from gpt at each step before conditioning and re-pruning')
     parser.add_argument('--do_sample', action='store_true', default=False, help='sample instead of greedy')
+    parser.add_argument('--topk', type=int, default=0, help='when sampling, only sample from the top k reweighted candidates; 0 for all of them')
+    parser.add_argument('--top_p', type=float, default=1.0, help='when sampling, only sample from the smallest set of reweighted candidates with this much probability')
+    parser.add_argument('--num_beams', type=int, default=1, help='beam search with this many beams if > 1')
     parser.add_argument('--condition_lambda', type=float, default=1.0, help='lambda weight on conditioning model')
     parser.add_argument('--length_cutoff', type=int, default=512, help='max length')
 
@@ -17,10 +17,14 @@ from transformers import AutoTokenizer, AutoModelWithLMHead, pipeline, set_seed,
 from data import Dataset, load_rhyme_info
 from model import Model
 from util import save_checkpoint, ProgressMeter, AverageMeter, num_params
+import fudge
+from fudge import IncrementalPredictor, candidate_inputs, left_pad_prompts
 from constants import *
-from poetry_util import get_rhymes, count_syllables
+from poetry_util import get_rhymes, count_syllables, load_phonetics_table, token_word_boundaries
 
 def main(args):
+    if args.phonetics_table is not None:
+        load_phonetics_table(args.phonetics_table)
     with open(args.dataset_info, 'rb') as rf:
         dataset_info = pickle.load(rf)
     gpt_tokenizer = AutoTokenizer.from_pretrained(args.model_string)
@@ -80,113 +84,178 @@ def main(args):
 
 
 def predict_couplet(gpt_model, gpt_tokenizer, iambic_model, rhyme_model, newline_model, input_text, dataset_info, rhyme_info, precondition_topk, postcondition_topk, condition_lambda=1.0, device='cuda'):
-    assert len(input_text) == 1 # only do one at a time for now
-    current_text = input_text[0]
-    current_line_text = ''
-    all_lines = [current_text]
-    ending_word = current_text.split()[-1].strip(string.punctuation)
+    assert len(input_text) == 1 # only do one at a time here; use predict_couplets for a batch
+    return predict_couplets(gpt_model, gpt_tokenizer, iambic_model, rhyme_model, newline_model, input_text, dataset_info, rhyme_info, precondition_topk, postcondition_topk, condition_lambda=condition_lambda, device=device)[0]
+
+
+def predict_couplets(gpt_model, gpt_tokenizer, iambic_model, rhyme_model, newline_model, input_text, dataset_info, rhyme_info, precondition_topk, postcondition_topk, condition_lambda=1.0, device='cuda', predictor_threads=1):
+    """
+    complete a couplet for each prefix line in input_text, sharing the gpt and predictor forward passes across the batch.
+    predictor_threads: run the iambic, rhyme and newline predictors concurrently on this many threads; see fudge.generate
+    returns [prefix line, generated line] for each input.
+    """
     word2rhyme_group = defaultdict(lambda: UNKNOWN_RHYME_GROUP, rhyme_info.word2rhyme_group)
-    rhyme_group = word2rhyme_group[ending_word]
+    rhyme_groups = [word2rhyme_group[current_text.split()[-1].strip(string.punctuation)] for current_text in input_text]
 
-    line = predict_iambic_pentameter_line(gpt_model, 
+    lines = predict_iambic_pentameter_lines(gpt_model, 
                         gpt_tokenizer, 
                         iambic_model, 
                         rhyme_model, 
                         newline_model,
-                        current_text,
-                        current_line_text,
-                        rhyme_group,
+                        input_text,
+                        ['' for _ in input_text],
+                        rhyme_groups,
                         dataset_info, 
                         rhyme_info,
                         precondition_topk, 
                         postcondition_topk,
                         condition_lambda=condition_lambda,
-                        device=device)
-    all_lines.append(line)
+                        device=device,
+                        predictor_threads=predictor_threads)
 
-    return all_lines
+    return [[current_text, line] for current_text, line in zip(input_text, lines)]
 
 
 def predict_iambic_pentameter_line(gpt_model, gpt_tokenizer, iambic_model, rhyme_model, newline_model, current_text, current_line_text, rhyme_group, dataset_info, rhyme_info, precondition_topk, postcondition_topk, banned_tokens=POETRY_BANNED_TOKENS, condition_lambda=1.0, device='cuda', length_cutoff=30):
+    return predict_iambic_pentameter_lines(gpt_model, gpt_tokenizer, iambic_model, rhyme_model, newline_model, [current_text], [current_line_text], [rhyme_group], dataset_info, rhyme_info, precondition_topk, postcondition_topk, banned_tokens=banned_tokens, condition_lambda=condition_lambda, device=device, length_cutoff=length_cutoff)[0]
+
+
+def line_syllable_counts(gpt_tokenizer, line_tokens):
+    """
+    syllables in the complete words of the line so far, depending on what kind of token comes next; 
+    indexed by TOKEN_STARTS_WORD, TOKEN_IS_WHITESPACE, TOKEN_CONTINUES_WORD.
+    a new word completes every word so far; whitespace leaves the last word out (it's still the last word after splitting);
+    and a continuation leaves out the last word it continues, unless the line already ends in whitespace.
+    """
+    line_text = gpt_tokenizer.decode(line_tokens)
+    syllables = count_syllables(line_text)
+    syllables_but_last = count_syllables(' '.join(line_text.split()[:-1]))
+    if len(line_text) == 0 or line_text[-1].isspace():
+        return syllables, syllables_but_last, syllables
+    return syllables, syllables_but_last, syllables_but_last
+
+
+class LineSyllables:
+    """
+    the syllable counts of each row's line so far (from line_syllable_counts, cached by line), and from them each candidate's syllables_to_go.
+    a candidate's syllables_to_go counts the complete words of the line before its last word. that only depends on the line so far 
+    and on whether the candidate starts a new word, is whitespace, or continues the last word, so we look up each candidate's kind
+    in a per-token table, instead of decoding and counting every candidate.
+    line_start: where the current line starts in each row of the generate batch; batch
+    """
+    def __init__(self, gpt_tokenizer, line_start):
+        self.gpt_tokenizer = gpt_tokenizer
+        self.line_start = line_start
+        self.word_boundaries = torch.LongTensor(token_word_boundaries(gpt_tokenizer)).to(line_start.device) # vocab
+        self.line_counts = {} # line tokens -> line_syllable_counts
+
+
+    def counts(self, input_ids, rows):
+        """
+        line_syllable_counts of each row's line; batch x 3
+        """
+        counts = []
+        for tokens, line_start in zip(input_ids.tolist(), self.line_start[rows].tolist()):
+            line_tokens = tuple(tokens[line_start:])
+            if line_tokens not in self.line_counts:
+                self.line_counts[line_tokens] = line_syllable_counts(self.gpt_tokenizer, line_tokens)
+            counts.append(self.line_counts[line_tokens])
+        return torch.LongTensor(counts).to(input_ids.device)
+
+
+    def __call__(self, input_ids, candidates, rows):
+        return POETRY_LINE_SYLLABLES - self.counts(input_ids, rows).gather(1, self.word_boundaries[candidates]) # batch x K
+
+
+class RhymePredictor:
+    """
+    fudge predictor for the rhyme: log prob that the line will end in each row's rhyme group, for each candidate. 
+    the rhyme predictor is bidirectional, so it reruns over the whole text with each candidate.
+    text_start: where the text starts in each row of the generate batch, past the left padding; batch
+    future_words: rhyme group index of each row; batch x 1
+    log_probs: its log prob; batch x 1
+    """
+    def __init__(self, rhyme_model, text_start, future_words, log_probs, line_syllables):
+        self.rhyme_model = rhyme_model
+        self.text_start = text_start
+        self.future_words = future_words
+        self.log_probs = log_probs
+        self.line_syllables = line_syllables
+
+
+    def __call__(self, input_ids, candidates, rows):
+        batch_size, num_candidates = candidates.shape
+        new_input_candidates, lengths = candidate_inputs(input_ids, self.text_start[rows], candidates) # batch x K x seq+1, batch
+        expanded_lengths = (lengths + 1).unsqueeze(1).expand(batch_size, num_candidates) # batch x K
+        expanded_future_words = self.future_words[rows].unsqueeze(1).expand(-1, num_candidates, -1) # batch x K x N
+        expanded_log_probs = self.log_probs[rows].unsqueeze(1).expand(-1, num_candidates, -1) # batch x K x N
+        expanded_syllables_to_go = self.line_syllables(input_ids, candidates, rows) # batch x K
+        rhyme_logits = self.rhyme_model(new_input_candidates.flatten(0, 1), # batch*K x seq+1
+                                            expanded_lengths.flatten(0, 1), # batch*K
+                                            expanded_future_words.flatten(0, 1), # batch*K x N
+                                            expanded_log_probs.flatten(0, 1), # batch*K x N
+                                            expanded_syllables_to_go.flatten(0, 1)) # batch*K
+        rhyme_logits = rhyme_logits.view(batch_size, num_candidates, -1) # batch x K x N
+        rhyme_logits = rhyme_logits - torch.log(1 + torch.exp(rhyme_logits)) # batch x K x N
+        return rhyme_logits.squeeze(2) # batch x K
+
+
+class LineEnd:
+    """
+    stopping criterion for fudge.generate: a row is done once its line has all its syllables and ends a phrase, or has too many syllables. 
+    if we get very unlucky with a partial word that the syllable counter doesn't recognize we might end early, but it's unlikely.
+    """
+    def __init__(self, gpt_tokenizer, line_syllables, text_start):
+        self.gpt_tokenizer = gpt_tokenizer
+        self.line_syllables = line_syllables
+        self.text_start = text_start
+
+
+    def __call__(self, input_ids, rows):
+        syllables_to_go = (POETRY_LINE_SYLLABLES - self.line_syllables.counts(input_ids, rows)[:, 0]).tolist()
+        return torch.BoolTensor([row_syllables_to_go < 0 or (row_syllables_to_go <= 0 and self.gpt_tokenizer.decode(tokens[text_start:])[-1] in PHRASE_ENDS)
+                                 for tokens, text_start, row_syllables_to_go in zip(input_ids, self.text_start[rows].tolist(), syllables_to_go)]).to(input_ids.device)
+
+
+def predict_iambic_pentameter_lines(gpt_model, gpt_tokenizer, iambic_model, rhyme_model, newline_model, current_texts, current_line_texts, rhyme_groups, dataset_info, rhyme_info, precondition_topk, postcondition_topk, banned_tokens=POETRY_BANNED_TOKENS, condition_lambda=1.0, device='cuda', length_cutoff=30, predictor_threads=1):
+    """
+    generate the rest of the current line for each row. each row has its own text so far, rhyme group and syllable budget;
+    gpt sees the rows left-padded. the sampling itself is fudge.generate, with the iambic, rhyme and newline predictors each weighted
+    by condition_lambda, and the end of the line as a stopping criterion; finished lines leave the batch.
+    """
     # TODO(poetry) delete banned tokens?
     with torch.no_grad():
-        batch_size = 1
-
-        rhyme_group_index = rhyme_info.rhyme_group2index[rhyme_group]
-        future_words = torch.LongTensor([rhyme_group_index]).to(device) # 1
-        log_probs = torch.Tensor([math.log(rhyme_info.rhyme_group_counts[rhyme_group] / rhyme_info.total_rhyme_groups)]).to(device) # 1
-
-        # assumes initially all same length.
-        previous_encoded_text = [gpt_tokenizer.encode(it, return_tensors='pt').to(device) for it in [current_text]]
-        previous_enc_len = previous_encoded_text[0].shape[1]
-        encoded_input = [gpt_tokenizer.encode(it, return_tensors='pt').to(device) for it in [current_text + current_line_text]] # batch x seq
-        encoded_input = torch.cat(encoded_input, dim=0)
-        lengths = torch.LongTensor([encoded_input.shape[1]]).to(device)
-
-        line_syllable_count = count_syllables(current_line_text)
-        assert line_syllable_count < POETRY_LINE_SYLLABLES # assume we started with less than one full line
-        syllables_to_go = POETRY_LINE_SYLLABLES - line_syllable_count
-
-        for _ in range(length_cutoff): # really shouldn't have a line this long anyway
-            gpt_logits = gpt_model(encoded_input)[0][:, -1, :] # batch x vocab
-            gpt_logits[:, banned_tokens] = -1e8
-            top_logits, top_indices = gpt_logits.topk(precondition_topk, dim=1)
-
-            new_input_candidates = torch.cat([encoded_input.unsqueeze(1).expand(-1, precondition_topk, -1), top_indices.unsqueeze(2)], dim=2) # batch x topk x seq+1
-            expanded_lengths = (lengths + 1).unsqueeze(1).expand(batch_size, precondition_topk) # batch x topk
-            expanded_future_words = future_words.unsqueeze(0).unsqueeze(1).expand(batch_size, precondition_topk, -1) # batch x topk x N
-            candidate_syllables_to_go = []
-            for candidate in new_input_candidates[0]:
-                candidate_until_last_word_text = ' '.join(gpt_tokenizer.decode(candidate[previous_enc_len:]).split()[:-1])
-                candidate_syllables_to_go.append(10 - count_syllables(candidate_until_last_word_text))
-                # usually these are all the same, but run them all for correctness. could do more efficiently but it's not too slow anyway.
-            expanded_syllables_to_go = torch.LongTensor(candidate_syllables_to_go).to(device).view(1, precondition_topk)
-
-            if condition_lambda == 0:
-                iambic_logits = torch.zeros_like(expanded_lengths).float()
-            else:
-                # truncate prefix because we trained on single lines
-                iambic_logits = iambic_model(new_input_candidates[:, :, previous_enc_len:].flatten(0, 1), expanded_lengths.flatten(0, 1) - previous_enc_len, None, None, None)[:, -1] # batch*topk x seq+1 -> batch*topk
-                iambic_logits = iambic_logits.view(batch_size, precondition_topk)
-                iambic_logits = iambic_logits - torch.log(1 + torch.exp(iambic_logits))
-            if condition_lambda == 0:
-                rhyme_logits = torch.zeros_like(expanded_lengths).float()
-            else:
-                rhyme_logits = rhyme_model(new_input_candidates.flatten(0, 1), # batch*topk x seq+1
-                                                    expanded_lengths.flatten(0, 1), # batch*topk
-                                                    expanded_future_words.flatten(0, 1), # batch*topk x N
-                                                    log_probs, # N
-                                                    expanded_syllables_to_go.flatten(0, 1)) # batch*topk
-                rhyme_logits = rhyme_logits.view(batch_size, precondition_topk, -1) # batch x topk x N
-                rhyme_logits = rhyme_logits - torch.log(1 + torch.exp(rhyme_logits)) # batch x topk x N
-                rhyme_logits = rhyme_logits.squeeze(2) # batch x topk
-            if condition_lambda == 0:
-                newline_logits = torch.zeros_like(expanded_lengths).float()
-            else:
-                newline_logits = newline_model(new_input_candidates.flatten(0, 1), # batch*topk x seq+1
-                                                    expanded_lengths.flatten(0, 1), # batch*topk
-                                                    expanded_future_words.flatten(0, 1), # batch*topk x N
-                                                    log_probs, # N
-                                                    expanded_syllables_to_go.flatten(0, 1)) # batch*topk
-                newline_logits = newline_logits[:, -1].view(batch_size, precondition_topk, -1) # batch x topk x N
-                newline_logits = newline_logits - torch.log(1 + torch.exp(newline_logits)) # batch x topk x N
-                newline_logits = newline_logits.squeeze(2) # batch x topk
-            
-            full_logits = top_logits + condition_lambda * iambic_logits + condition_lambda * rhyme_logits + condition_lambda * newline_logits
-            post_logits, post_indices = full_logits.topk(postcondition_topk, dim=1)
-            post_probs = F.softmax(post_logits, dim=1)
-            index_into_top_indices = post_indices[torch.arange(batch_size).to(post_indices.device), torch.multinomial(post_probs, 1).flatten()] # batch
-            next_indices = top_indices[torch.arange(batch_size).to(top_indices.device), index_into_top_indices] # batch
-            encoded_input = torch.cat([encoded_input, next_indices.unsqueeze(1)], dim=1) # batch x seq+1
-            lengths = lengths + 1
-            syllables_to_go = POETRY_LINE_SYLLABLES - count_syllables(gpt_tokenizer.decode(encoded_input[0][previous_enc_len:])) # if we get very unlucky with a partial word that the syllable counter doesn't recognize we might end early, but it's unlikely
-            if syllables_to_go <= 0 and [gpt_tokenizer.decode(s) for s in encoded_input][0][-1] in PHRASE_ENDS:
-                break
-            if syllables_to_go < 0:
-                # encoded_input = encoded_input[:, :-1]
-                break
-
-        return [gpt_tokenizer.decode(s) for s in encoded_input][0][len(current_text):]
+        batch_size = len(current_texts)
+
+        future_words = torch.LongTensor([[rhyme_info.rhyme_group2index[rhyme_group]] for rhyme_group in rhyme_groups]).to(device) # batch x 1
+        log_probs = torch.Tensor([[math.log(rhyme_info.rhyme_group_counts[rhyme_group] / rhyme_info.total_rhyme_groups)] for rhyme_group in rhyme_groups]).to(device) # batch x 1
+
+        previous_enc_lens = torch.LongTensor([len(gpt_tokenizer.encode(current_text)) for current_text in current_texts]).to(device) # batch
+        row_tokens = [gpt_tokenizer.encode(current_text + current_line_text) for current_text, current_line_text in zip(current_texts, current_line_texts)] # full text of each row so far
+        for current_line_text in current_line_texts:
+            assert count_syllables(current_line_text) < POETRY_LINE_SYLLABLES # assume we started with less than one full line
+
+        encoded_input, attention_mask, num_pad = left_pad_prompts(row_tokens, device) # batch x seq; the pad is masked out
+
+        line_start = num_pad + previous_enc_lens # batch
+        line_syllables = LineSyllables(gpt_tokenizer, line_start)
+        predictors = [(IncrementalPredictor(iambic_model, line_start), condition_lambda), # truncate prefix because we trained on single lines
+                      (RhymePredictor(rhyme_model, num_pad, future_words, log_probs, line_syllables), condition_lambda),
+                      (IncrementalPredictor(newline_model, num_pad, step_inputs=lambda input_ids, candidates, rows: (line_syllables(input_ids, candidates, rows),)), condition_lambda)]
+        line_end = LineEnd(gpt_tokenizer, line_syllables, num_pad)
+        output = fudge.generate(gpt_model,
+                                encoded_input,
+                                predictors,
+                                precondition_topk=precondition_topk,
+                                stopping_criteria=[line_end],
+                                predictor_threads=predictor_threads,
+                                attention_mask=attention_mask,
+                                max_new_tokens=length_cutoff, # really shouldn't have a line this long anyway
+                                do_sample=True,
+                                top_k=postcondition_topk,
+                                bad_words_ids=[[token] for token in banned_tokens]) # no eos_token_id: lines end at line_end instead
+        
+        return [gpt_tokenizer.decode(tokens[npad:])[len(current_text):] for tokens, npad, current_text in zip(output, num_pad.tolist(), current_texts)]
 
 
 if __name__=='__main__':
@@ -198,6 +267,7 @@ if __name__=='__main__':
     parser.add_argument('--newline_ckpt', type=str, required=True)
     parser.add_argument('--dataset_info', type=str, required=True, help='saved dataset info')
     parser.add_argument('--rhyme_info', type=str, required=True, help='saved rhyme info')
+    parser.add_argument('--phonetics_table', type=str, default=None, help='precompiled phonetics from poetry_util.py, to speed up syllable/stress/rhyme lookups')
     parser.add_argument('--model_string', type=str, default='gpt2-medium')
 
     parser.add_argument('--input_text', type=str, default=None, required=True, help='initial text')
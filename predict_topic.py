@@ -15,6 +15,8 @@ from transformers import AutoTokenizer, AutoModelWithLMHead, pipeline, set_seed,
 from data import Dataset
 from model import Model
 from util import save_checkpoint, ProgressMeter, AverageMeter, num_params
+import fudge
+from fudge import RowMaxLength, candidate_inputs, left_pad_prompts
 from constants import *
 
 def main(args):
@@ -53,48 +55,112 @@ def main(args):
         print(results)
         import pdb; pdb.set_trace()
 
-def predict(gpt_model, gpt_tokenizer, conditioning_model, input_text, condition_words, dataset_info, precondition_topk, postcondition_topk, length_cutoff, condition_lambda=1.0, device='cuda'):
+class TopicPredictor:
+    """
+    fudge predictor for topic: the mean log prob over each row's condition words that they appear later in the text, 
+    for each candidate. the topic predictor is bidirectional, so it reruns over the whole text with each candidate.
+    text_start: where the prompt starts in each row of the generate batch, past the left padding; batch
+    future_words: condition words of each row, padded with 0; batch x N
+    log_probs: their unigram log probs; batch x N
+    word_weights: weight of each word's log prob, batch x N; by default 1 / the row's number of condition words (0 for padding), 
+        i.e. the mean. fusing topics concatenates their words, with each topic's weights scaled by its condition_lambda.
+    """
+    def __init__(self, conditioning_model, text_start, future_words, log_probs, length_cutoff, word_weights=None):
+        self.conditioning_model = conditioning_model
+        self.text_start = text_start
+        self.future_words = future_words
+        self.log_probs = log_probs
+        self.length_cutoff = length_cutoff
+        if word_weights is None:
+            future_word_mask = (future_words != 0).float() # batch x N
+            word_weights = future_word_mask / future_word_mask.sum(dim=1, keepdim=True)
+        self.word_weights = word_weights
+
+
+    def fuse_key(self):
+        return (self.conditioning_model, id(self.text_start), self.length_cutoff)
+
+
+    @staticmethod
+    def fuse(predictors):
+        """
+        one predictor scoring every topic's words in the same pass, giving the weighted sum of the topics' log probs
+        """
+        return TopicPredictor(predictors[0][0].conditioning_model,
+                              predictors[0][0].text_start,
+                              torch.cat([predictor.future_words for predictor, _ in predictors], dim=1),
+                              torch.cat([predictor.log_probs for predictor, _ in predictors], dim=1),
+                              predictors[0][0].length_cutoff,
+                              word_weights=torch.cat([condition_lambda * predictor.word_weights for predictor, condition_lambda in predictors], dim=1))
+
+
+    def __call__(self, input_ids, candidates, rows):
+        batch_size, num_candidates = candidates.shape
+        new_input_candidates, lengths = candidate_inputs(input_ids, self.text_start[rows], candidates) # batch x K x seq+1, batch
+        future_words, log_probs = self.future_words[rows], self.log_probs[rows] # batch x N
+        expanded_lengths = (lengths + 1).unsqueeze(1).expand(batch_size, num_candidates) # batch x K
+        expanded_future_words = future_words.unsqueeze(1).expand(-1, num_candidates, -1) # batch x K x N
+        expanded_log_probs = log_probs.unsqueeze(1).expand(-1, num_candidates, -1) # batch x K x N
+        expanded_tokens_left = (self.length_cutoff - lengths).unsqueeze(1).expand(-1, num_candidates) # batch x K
+        condition_logits = self.conditioning_model(new_input_candidates.flatten(0, 1), # batch*K x seq+1
+                                                expanded_lengths.flatten(0, 1), # batch*K
+                                                expanded_future_words.flatten(0, 1), # batch*K x N
+                                                expanded_log_probs.flatten(0, 1), # batch*K x N
+                                                expanded_tokens_left.flatten(0, 1)) # batch*K
+        condition_logits = condition_logits.view(batch_size, num_candidates, -1) # batch x K x N
+        condition_logits = condition_logits - torch.log(1 + torch.exp(condition_logits)) # get correct log probs
+        return (condition_logits * self.word_weights[rows].unsqueeze(1)).sum(dim=2) # weighted over each row's real condition words
+
+
+def condition_word_tensors(condition_words, dataset_info, batch_size, device):
+    """
+    condition_words: space-separated condition words shared by all prompts, or a list with one such string per prompt
+    returns: the words' indices, padded with 0, batch x N; and their unigram log probs, batch x N
+    """
+    if isinstance(condition_words, str):
+        condition_words = [condition_words for _ in range(batch_size)]
+    condition_words = [cw.split() for cw in condition_words]
+    assert len(condition_words) == batch_size and all(len(cw) > 0 for cw in condition_words)
+    num_words = max(len(cw) for cw in condition_words)
+    future_words = torch.LongTensor([[dataset_info.word2index[w] for w in cw] + [0 for _ in range(num_words - len(cw))] for cw in condition_words]).to(device) # batch x N, padded with 0
+    log_probs = torch.Tensor([[math.log(dataset_info.vocab[w] / dataset_info.total_words) for w in cw] + [0 for _ in range(num_words - len(cw))] for cw in condition_words]).to(device) # batch x N
+    return future_words, log_probs
+
+
+def predict(gpt_model, gpt_tokenizer, conditioning_model, input_text, condition_words, dataset_info, precondition_topk, postcondition_topk, length_cutoff, condition_lambda=1.0, device='cuda', use_cache=True, extra_topics=(), predictor_threads=1):
+    """
+    input_text: list of prompts. they can encode to different lengths; gpt sees them left-padded with an attention mask,
+        and each row is generated until it reaches length_cutoff tokens in total, then dropped from the batch.
+    condition_words: space-separated condition words shared by all prompts, or a list with one such string per prompt
+    use_cache: carry gpt's past_key_values between steps and only feed the newly chosen token, instead of rerunning the whole prefix each step.
+        gives the same samples under a fixed seed, just faster.
+    extra_topics: list of (condition_words, condition_lambda) for more topics to steer toward at the same time, each weighted separately.
+        all the topics are fused into one run of the conditioning model per candidate.
+    predictor_threads: see fudge.generate
+    the sampling itself is fudge.generate, with a topic predictor per topic.
+    """
     with torch.no_grad():
         batch_size = len(input_text)
 
-        condition_words = condition_words.split()
-        future_words = torch.LongTensor([dataset_info.word2index[cw] for cw in condition_words]).to(device) # N
-        log_probs = torch.Tensor([math.log(dataset_info.vocab[cw] / dataset_info.total_words) for cw in condition_words]).to(device) # N
-
-        # assumes initially all same length.
-        encoded_input = [gpt_tokenizer.encode(it, return_tensors='pt').to(device) for it in input_text] # batch x seq
-        encoded_input = torch.cat(encoded_input, dim=0)
-        lengths = torch.LongTensor([encoded_input.shape[1]]).to(device)
-
-        gpt_encoded_future_words = [gpt_tokenizer.encode(' ' + cw, return_tensors='pt')[0].to(device) for cw in condition_words]
-        while lengths.max() < length_cutoff:
-            tokens_left = torch.LongTensor([length_cutoff - lengths.max() for _ in range(batch_size)]).to(device)
-            gpt_logits = gpt_model(encoded_input)[0][:, -1, :] # batch x vocab
-            top_logits, top_indices = gpt_logits.topk(precondition_topk, dim=1) # batch x topk
-            new_input_candidates = torch.cat([encoded_input.unsqueeze(1).expand(-1, precondition_topk, -1), top_indices.unsqueeze(2)], dim=2) # batch x topk x seq+1
-            expanded_lengths = (lengths + 1).unsqueeze(1).expand(batch_size, precondition_topk) # batch x topk
-            expanded_future_words = future_words.unsqueeze(0).unsqueeze(1).expand(batch_size, precondition_topk, -1) # batch x topk x N
-            expanded_tokens_left = tokens_left.unsqueeze(1).expand(-1, precondition_topk) # batch x topk
-            if condition_lambda == 0:
-                condition_logits = torch.zeros_like(expanded_future_words).float()
-            else:
-                condition_logits = conditioning_model(new_input_candidates.flatten(0, 1), # batch*topk x seq+1
-                                                    expanded_lengths.flatten(0, 1), # batch*topk
-                                                    expanded_future_words.flatten(0, 1), # batch*topk x N
-                                                    log_probs, # N
-                                                    expanded_tokens_left.flatten(0, 1)) # batch*topk
-                condition_logits = condition_logits.view(batch_size, precondition_topk, -1) # batch x topk x N
-                condition_logits = condition_logits - torch.log(1 + torch.exp(condition_logits)) # get correct log probs
-
-            condition_logits = torch.mean(condition_logits, dim=2)
-            full_logits = top_logits + condition_logits * condition_lambda # batch x topk
-            post_logits, post_indices = full_logits.topk(postcondition_topk, dim=1)
-            post_probs = F.softmax(post_logits, dim=1)
-            index_into_top_indices = post_indices[torch.arange(batch_size).to(post_indices.device), torch.multinomial(post_probs, 1).flatten()] # batch
-            next_indices = top_indices[torch.arange(batch_size).to(top_indices.device), index_into_top_indices] # batch
-            encoded_input = torch.cat([encoded_input, next_indices.unsqueeze(1)], dim=1) # batch x seq+1
-            lengths = lengths + 1 # batch
-        return [gpt_tokenizer.decode(s) for s in encoded_input]
+        encoded_prompts = [gpt_tokenizer.encode(it) for it in input_text]
+        encoded_input, attention_mask, num_pad = left_pad_prompts(encoded_prompts, device) # batch x seq; the pad is masked out
+        lengths = encoded_input.shape[1] - num_pad # batch, number of real tokens in each row
+
+        # each row leaves the batch once it reaches length_cutoff; prompts already past it are returned as is
+        predictors = [(TopicPredictor(conditioning_model, num_pad, *condition_word_tensors(topic_words, dataset_info, batch_size, device), length_cutoff), topic_lambda)
+                      for topic_words, topic_lambda in [(condition_words, condition_lambda)] + list(extra_topics)]
+        output = fudge.generate(gpt_model,
+                                encoded_input,
+                                predictors,
+                                precondition_topk=precondition_topk,
+                                stopping_criteria=[RowMaxLength(length_cutoff, num_pad)],
+                                predictor_threads=predictor_threads,
+                                attention_mask=attention_mask,
+                                max_new_tokens=length_cutoff - lengths.min().item(),
+                                do_sample=True,
+                                top_k=postcondition_topk,
+                                use_cache=use_cache) # no eos_token_id: keep going past eos, to length_cutoff
+        return [gpt_tokenizer.decode(s[npad:]) for s, npad in zip(output, num_pad.tolist())]
         
 
 if __name__=='__main__':
@@ -1,8 +1,14 @@
 import os
+import re
+import shutil
 import time
 import sys
-from contextlib import contextmanager
+import random
+import queue
+import threading
+from contextlib import contextmanager, nullcontext
 
+import numpy as np
 import torch
 
 from constants import *
@@ -18,9 +24,177 @@ def suppress_stdout():
             sys.stdout = old_stdout
 
 
+PRECISION_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def autocast(device, precision):
+    """
+    run the ops inside in reduced precision for --precision bf16 or fp16 (the weights stay fp32). does nothing for fp32.
+    """
+    if precision == 'fp32':
+        return nullcontext()
+    return torch.autocast(device_type=device, dtype=PRECISION_DTYPES[precision])
+
+
+def grad_scaler(device, precision):
+    """
+    loss scaling so fp16 gradients don't underflow. a pass-through for fp32, and for bf16 which has the same range as fp32.
+    """
+    return torch.amp.GradScaler(device, enabled=precision == 'fp16')
+
+
 def save_checkpoint(state, save_path):
+    """
+    write to a temp file and rename it into place, so save_path never holds a half-written checkpoint.
+    """
     os.makedirs(os.path.dirname(save_path), exist_ok=True)
-    torch.save(state, save_path)
+    tmp_path = save_path + '.tmp'
+    with open(tmp_path, 'wb') as wf:
+        torch.save(state, wf)
+        wf.flush()
+        os.fsync(wf.fileno())
+    os.replace(tmp_path, save_path)
+
+
+def copy_checkpoint(path, save_path):
+    """
+    put the checkpoint already written at path at save_path too, without serializing it again: a hardlink where the filesystem allows 
+    (checkpoints are only ever replaced, never written in place, so the two names can share the file), else a copy. atomic like save_checkpoint.
+    """
+    tmp_path = save_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(path, tmp_path)
+    except OSError:
+        shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, save_path)
+
+
+def checkpoint_epoch(path):
+    """
+    the epoch of a model_epoch*.pth.tar path, or None for any other file
+    """
+    match = re.fullmatch(r'model_epoch(\d+)\.pth\.tar', os.path.basename(path))
+    return int(match.group(1)) if match is not None else None
+
+
+def rng_states():
+    """
+    the global python, numpy, and torch (cpu and cuda) rng states, to save in a checkpoint.
+    """
+    states = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'].cpu())
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([state.cpu() for state in states['cuda']])
+
+
+def cpu_copy(state):
+    """
+    copy of a (nested) checkpoint dict with every tensor copied to cpu, so training can keep updating the originals.
+    """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, cpu_copy(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_copy(value) for value in state)
+    return state
+
+
+class CheckpointWriter:
+    """
+    saves checkpoints on a background thread so training doesn't wait on the disk. each save snapshots the state to cpu memory
+    right away and is written atomically with save_checkpoint. only the keep_last most recent checkpoints are kept on disk 
+    (all of them if keep_last is None), besides model_best.pth.tar and model_latest.pth.tar; that counts the model_epoch*.pth.tar 
+    already in save_dir, e.g. from before a resume. a checkpoint going to several paths is serialized once and linked or copied to the rest.
+    at most one save waits behind the one being written, so the cpu copies can't pile up if the disk falls behind: a save that's 
+    just model_latest.pth.tar replaces a waiting one of those, and any other save blocks until there's room.
+    """
+    def __init__(self, save_dir, keep_last=None):
+        self.save_dir = save_dir
+        self.keep_last = keep_last
+        self.saved_paths = sorted([os.path.join(save_dir, filename) for filename in os.listdir(save_dir) if checkpoint_epoch(filename) is not None], 
+                                  key=checkpoint_epoch) if os.path.isdir(save_dir) else [] # oldest first
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+
+    def write_loop(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is not None and self.error is None:
+                    state, filename, paths = job
+                    save_checkpoint(state, paths[0])
+                    for path in paths[1:]:
+                        copy_checkpoint(paths[0], path)
+                    if filename is not None:
+                        self.saved_paths = [path for path in self.saved_paths if path != paths[0]] + [paths[0]] # e.g. an epoch redone after a resume
+                    while self.keep_last is not None and len(self.saved_paths) > self.keep_last:
+                        os.remove(self.saved_paths.pop(0))
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+            if job is None:
+                return
+
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError('checkpoint writing failed') from self.error
+
+
+    def save(self, state, filename=None, best=False, latest=False):
+        """
+        queue state to be written to save_dir/filename, and to save_dir/model_best.pth.tar if best and save_dir/model_latest.pth.tar if latest. 
+        returns without waiting for the writes, unless another save is already waiting.
+        """
+        self.check()
+        paths = ([os.path.join(self.save_dir, filename)] if filename is not None else []) \
+                + ([os.path.join(self.save_dir, 'model_best.pth.tar')] if best else []) \
+                + ([os.path.join(self.save_dir, 'model_latest.pth.tar')] if latest else [])
+        if paths == [os.path.join(self.save_dir, 'model_latest.pth.tar')]:
+            try: # only the newest model_latest.pth.tar matters, so one that's still waiting can go
+                waiting = self.queue.get_nowait()
+                self.queue.task_done()
+                if waiting[2] != paths: # something else, e.g. an epoch's checkpoint; it stays
+                    self.queue.put(waiting)
+            except queue.Empty:
+                pass
+        self.queue.put((cpu_copy(state), filename, paths))
+
+
+    def close(self):
+        """
+        wait for the queued checkpoints to be written.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+
+def select_rows(state, rows):
+    """
+    the given rows (along dim 0) of every tensor in a (nested) state, e.g. a decoder's cached past.
+    """
+    if torch.is_tensor(state):
+        return state.index_select(0, rows)
+    if isinstance(state, dict):
+        return type(state)((key, select_rows(value, rows)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(select_rows(value, rows) for value in state)
+    return state
 
 
 def freeze(module):
@@ -50,6 +224,15 @@ def pad_to_length(tensor, length, dim, value=0):
         return tensor
 
 
+def right_pad_tokens(token_lists, length=None, value=0):
+    """
+    Stack lists of token ids into a batch x length LongTensor, right-padded with value (length defaults to the longest list)
+    """
+    if length is None:
+        length = max(len(tokens) for tokens in token_lists)
+    return torch.LongTensor([list(tokens) + [value for _ in range(length - len(tokens))] for tokens in token_lists])
+
+
 def pad_mask(lengths: torch.LongTensor) -> torch.ByteTensor:
     """
     Create a mask of seq x batch where seq = max(lengths), with 0 in padding locations and 1 otherwise. 